@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+"""Benchmarks of the hot paths of keyedcache.
+
+Runs offline against the locmem, filebased and dummy backends and keyedcache's
+LocalObjectCache (``objects``) and prints or writes the results as JSON.
+Examples::
+
+    python benchmarks/run.py --output baseline.json
+    python benchmarks/run.py --compare baseline.json --threshold 0.15
+    python benchmarks/run.py --backends locmem --only cache_get --quick
+
+With ``--compare`` the exit status is 1 if any benchmark is slower than the
+baseline by more than the threshold (a fraction).
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BACKENDS = {
+    'locmem': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'bench'},
+    'filebased': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache'},
+    'dummy': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+    'objects': {'BACKEND': 'keyedcache.backends.LocalObjectCache', 'LOCATION': 'bench'},
+}
+
+
+def setup_django(cache_dir):
+    import django
+    from django.conf import settings
+
+    caches = {'default': BACKENDS['locmem']}
+    for name, config in BACKENDS.items():
+        caches[name] = dict(config, TIMEOUT=300)
+    caches['filebased']['LOCATION'] = cache_dir
+    settings.configure(
+        DEBUG=False,
+        SITE_ID=1,
+        SECRET_KEY='benchmark',
+        CACHES=caches,
+        KEYEDCACHE_ALIAS='locmem',
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        INSTALLED_APPS=['django.contrib.contenttypes', 'django.contrib.auth', 'keyedcache'],
+    )
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+def use_backend(name):
+    from django.conf import settings
+    import keyedcache
+    settings.KEYEDCACHE_ALIAS = name
+    keyedcache.keyedcache_configure()
+    keyedcache.CACHED_KEYS.clear()
+
+
+def measure(func, number, repeat):
+    """Nanoseconds per call: the best and the median of ``repeat`` runs."""
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        for j in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number * 1e9)
+    return {'best_ns': round(min(timings), 1), 'median_ns': round(statistics.median(timings), 1),
+            'number': number, 'repeat': repeat}
+
+
+class Pk(object):
+    """An object with a primary key, like a model instance."""
+
+    def __init__(self, pk):
+        self.pk = pk
+
+    def _get_pk_val(self):
+        return self.pk
+
+
+def key_benchmarks():
+    import keyedcache
+    shapes = {
+        'string': (('product',), {}),
+        'parts': (('product', 123, 'price'), {}),
+        'pairs': (('shipping',), {'weight': '2.5', 'country': 'CZ', 'zipcode': '11000'}),
+        'model': (('product', Pk(123)), {}),
+        'hashed': (('func', 'module', (1, 2, 3), {'a': [1, 2]}), {}),
+    }
+    for name, (args, kwargs) in shapes.items():
+        yield 'cache_key.%s' % name, (lambda args=args, kwargs=kwargs: keyedcache.cache_key(*args, **kwargs)), 1
+
+
+def access_benchmarks():
+    """With the dummy backend the cache is disabled and every get is a miss."""
+    import keyedcache
+
+    def get(*keys):
+        try:
+            return keyedcache.cache_get(*keys)
+        except keyedcache.NotCachedError:
+            return None
+
+    keyedcache.cache_set('bench', 'hit', value={'a': 1, 'b': [1, 2, 3]})
+    yield 'cache_get.hit', lambda: get('bench', 'hit'), 1
+    yield 'cache_get.miss', lambda: get('bench', 'miss'), 1
+    yield 'cache_set', lambda: keyedcache.cache_set('bench', 'set', value={'a': 1, 'b': [1, 2, 3]}), 1
+
+    def plain(a, b=2):
+        return a + b
+
+    cached = keyedcache.cache_function(300)(plain)
+    cached(1)
+    yield 'cache_function.hit', lambda: cached(1), 1
+    yield 'cache_function.baseline', lambda: plain(1), 1
+
+
+def delete_benchmarks(sizes):
+    import keyedcache
+
+    for size in sizes:
+        def setup(size=size):
+            keyedcache.CACHED_KEYS.clear()
+            for i in range(size):
+                keyedcache.CACHED_KEYS['other::%d' % i] = True
+            for i in range(100):
+                keyedcache.cache_set('tree', i, value=i)
+
+        def delete():
+            keyedcache.cache_delete('tree', children=True)
+
+        yield 'cache_delete.children.%d' % size, (setup, delete), 0
+
+
+def find_benchmarks():
+    import keyedcache
+    from django.contrib.auth.models import User
+    from keyedcache.models import find_by_id
+
+    user = User.objects.create_user('bench%d' % time.time_ns())
+    yield 'find_by_id.hit', lambda: find_by_id(User, 'user', user.pk), 1
+
+    def miss():
+        keyedcache.cache_delete('user', user.pk)
+        return find_by_id(User, 'user', user.pk)
+
+    yield 'find_by_id.miss', miss, 1
+
+
+def run(backends, only, sizes, number, repeat):
+    import keyedcache
+    results = {}
+    for backend in backends:
+        use_backend(backend)
+        results[backend] = {}
+        groups = [key_benchmarks(), access_benchmarks(), delete_benchmarks(sizes), find_benchmarks()]
+        for group in groups:
+            for name, func, scale in group:
+                if only and not any(name.startswith(prefix) for prefix in only):
+                    continue
+                if scale == 0:
+                    # (setup, operation) measured once per repeat
+                    setup, operation = func
+                    timings = []
+                    for i in range(repeat):
+                        setup()
+                        start = time.perf_counter()
+                        operation()
+                        timings.append((time.perf_counter() - start) * 1e9)
+                    result = {'best_ns': round(min(timings), 1), 'median_ns': round(statistics.median(timings), 1),
+                              'number': 1, 'repeat': repeat}
+                    keyedcache.CACHED_KEYS.clear()
+                else:
+                    result = measure(func, number, repeat)
+                results[backend][name] = result
+                print("%-10s %-32s %12.1f ns" % (backend, name, result['best_ns']), file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Prints the ratios to the baseline, returns the list of regressions."""
+    regressions = []
+    for backend, benchmarks in sorted(results.items()):
+        for name, result in sorted(benchmarks.items()):
+            old = baseline.get('results', {}).get(backend, {}).get(name)
+            if not old:
+                continue
+            ratio = result['best_ns'] / old['best_ns'] if old['best_ns'] else 1.0
+            flag = ''
+            if ratio > 1 + threshold:
+                flag = 'REGRESSION'
+                regressions.append((backend, name, ratio))
+            print("%-10s %-32s %6.2fx %s" % (backend, name, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', default='locmem,filebased,dummy,objects')
+    parser.add_argument('--only', default='', help="Comma separated prefixes of benchmark names.")
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help="Registered keys for the children deletion benchmarks.")
+    parser.add_argument('--number', type=int, default=2000, help="Calls per repeat.")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--quick', action='store_true', help="Fewer calls and smaller registries.")
+    parser.add_argument('--output', help="Write the results as JSON to this file.")
+    parser.add_argument('--compare', help="JSON results of a baseline run.")
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.number, args.repeat, args.sizes = 200, 3, '1000,10000'
+    backends = [b for b in args.backends.split(',') if b]
+    unknown = set(backends) - set(BACKENDS)
+    if unknown:
+        parser.error("unknown backends: %s" % ', '.join(sorted(unknown)))
+
+    cache_dir = tempfile.mkdtemp(prefix='keyedcache-bench-')
+    try:
+        setup_django(cache_dir)
+        import django
+        results = {
+            'meta': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'number': args.number,
+                'repeat': args.repeat,
+            },
+            'results': run(backends, [o for o in args.only.split(',') if o],
+                           [int(s) for s in args.sizes.split(',') if s], args.number, args.repeat),
+        }
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    elif not args.compare:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results['results'], baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""Concurrency stress test of keyedcache.
+
+Drives ``cache_get``, ``cache_set``, ``cache_delete(children=True)`` and
+``cache_function`` from many threads and forked processes sharing one
+filebased backend. Examples::
+
+    python benchmarks/stress.py
+    python benchmarks/stress.py --threads 1,4,16 --processes 1,4 --duration 5 --output stress.json
+
+Reports for every number of threads and processes:
+
+* throughput of the mixed workload and its scaling against one worker,
+* lost updates of ``CACHE_CALLS``, the calls counted by the workers minus
+  the increase of the counter,
+* exceptions raised by keyedcache, e.g. "dictionary changed size during
+  iteration" or a ``KeyError`` of a concurrently deleted key,
+* computations per key when all workers miss the same keys at once, for
+  ``cache_function`` and ``cache_get_or_compute``.
+
+The exit status is 1 if any worker got an exception.
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from run import setup_django, use_backend
+
+COMPUTE_SECONDS = 0.002
+
+computed = Counter()
+computed_lock = threading.Lock()
+
+
+def slow_square(n):
+    with computed_lock:
+        computed[n] += 1
+    time.sleep(COMPUTE_SECONDS)
+    return n * n
+
+
+def _record_error(errors, e):
+    name = "%s: %s" % (type(e).__name__, str(e)[:60])
+    errors[name] = errors.get(name, 0) + 1
+
+
+def mixed_worker(seed, duration, keys, function, barrier):
+    """The mixed workload of one thread; returns its counters."""
+    import keyedcache
+    rnd = random.Random(seed)
+    ops = calls = 0
+    errors = {}
+    barrier.wait()
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        n = rnd.randrange(keys)
+        group = n % 16
+        r = rnd.random()
+        try:
+            if r < 0.5:
+                calls += 1
+                keyedcache.cache_get('stress', group, n, default=None)
+            elif r < 0.75:
+                keyedcache.cache_set('stress', group, n, value=n)
+            elif r < 0.77:
+                keyedcache.cache_delete('stress', group, children=True)
+            else:
+                calls += 1
+                function(n)
+        except Exception as e:
+            _record_error(errors, e)
+        ops += 1
+    return {'ops': ops, 'calls': calls, 'errors': errors}
+
+
+def herd_worker(keys, method, barrier):
+    """Every worker asks for the same keys in the same order."""
+    import keyedcache
+    errors = {}
+    barrier.wait()
+    for n in range(keys):
+        try:
+            if method == 'cache_function':
+                cached_square(n)
+            else:
+                keyedcache.cache_get_or_compute(['stress', 'herd', n], lambda n=n: slow_square(n), length=60)
+        except Exception as e:
+            _record_error(errors, e)
+    return {'errors': errors}
+
+
+def cached_square(n):
+    return _cached_square(n)
+
+
+_cached_square = None
+
+
+def run_threads(count, target, args):
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def thread(i):
+        results[i] = target(*(args(i) + (barrier,)))
+
+    threads = [threading.Thread(target=thread, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def _process(queue, threads, target, args):
+    import keyedcache
+    calls_before = keyedcache.CACHE_CALLS
+    with computed_lock:
+        computed.clear()
+    results = run_threads(threads, target, args)
+    queue.put({'results': results, 'counted_calls': keyedcache.CACHE_CALLS - calls_before,
+               'computed': dict(computed)})
+
+
+def run_processes(count, target, args):
+    """One thread in each of ``count`` forked processes."""
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    processes = [context.Process(target=_process, args=(queue, 1, target, lambda j, i=i: args(i)))
+                 for i in range(count)]
+    for p in processes:
+        p.start()
+    outputs = [queue.get() for p in processes]
+    for p in processes:
+        p.join()
+    return outputs
+
+
+def merge_errors(results):
+    errors = {}
+    for result in results:
+        for name, count in result['errors'].items():
+            errors[name] = errors.get(name, 0) + count
+    return errors
+
+
+def clear():
+    """Empties the backend, also of the keys registered by forked processes."""
+    import keyedcache
+    keyedcache.cache.clear()
+    keyedcache.CACHED_KEYS.clear()
+
+
+def mixed(mode, count, duration, keys):
+    import keyedcache
+    clear()
+    args = lambda i: (i, duration, keys, cached_square)
+    if mode == 'threads':
+        calls_before = keyedcache.CACHE_CALLS
+        results = run_threads(count, mixed_worker, args)
+        lost = sum(r['calls'] for r in results) - (keyedcache.CACHE_CALLS - calls_before)
+    else:
+        outputs = run_processes(count, mixed_worker, args)
+        results = [r for output in outputs for r in output['results']]
+        lost = sum(sum(r['calls'] for r in output['results']) - output['counted_calls'] for output in outputs)
+    ops = sum(r['ops'] for r in results)
+    return {'mode': mode, 'workers': count, 'ops': ops, 'ops_per_sec': round(ops / duration, 1),
+            'lost_calls': lost, 'errors': merge_errors(results)}
+
+
+def herd(mode, count, keys, method):
+    clear()
+    with computed_lock:
+        computed.clear()
+    args = lambda i: (keys, method)
+    if mode == 'threads':
+        results = run_threads(count, herd_worker, args)
+        per_key = Counter(computed)
+    else:
+        outputs = run_processes(count, herd_worker, args)
+        results = [r for output in outputs for r in output['results']]
+        per_key = Counter()
+        for output in outputs:
+            per_key.update(output['computed'])
+    computations = sum(per_key.values())
+    return {'mode': mode, 'workers': count, 'method': method, 'keys': keys, 'computations': computations,
+            'duplicates': computations - len(per_key), 'max_per_key': max(per_key.values()) if per_key else 0,
+            'errors': merge_errors(results)}
+
+
+def main(argv=None):
+    global _cached_square
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', default='1,2,4,8')
+    parser.add_argument('--processes', default='1,2,4')
+    parser.add_argument('--duration', type=float, default=2.0, help="Seconds of every mixed run.")
+    parser.add_argument('--keys', type=int, default=500)
+    parser.add_argument('--herd-keys', type=int, default=50)
+    parser.add_argument('--output', help="Write the results as JSON to this file.")
+    args = parser.parse_args(argv)
+
+    cache_dir = tempfile.mkdtemp(prefix='keyedcache-stress-')
+    try:
+        setup_django(cache_dir)
+        use_backend('filebased')
+        import keyedcache
+        _cached_square = keyedcache.cache_function(60)(slow_square)
+        # the first cache_get of a process makes one more through cache_require
+        keyedcache.cache_get('stress', default=None)
+
+        runs = [('threads', int(n)) for n in args.threads.split(',') if n]
+        runs += [('processes', int(n)) for n in args.processes.split(',') if n]
+        results = {'mixed': [], 'herd': []}
+        for mode, count in runs:
+            result = mixed(mode, count, args.duration, args.keys)
+            single = [r for r in results['mixed'] if r['mode'] == mode and r['workers'] == 1]
+            if single and single[0]['ops']:
+                result['scaling'] = round(float(result['ops']) / single[0]['ops'], 2)
+            results['mixed'].append(result)
+            print("%-9s %3d  %10.1f ops/s  scaling %-5s lost calls %-6d errors %d" % (
+                mode, count, result['ops_per_sec'], result.get('scaling', '-'), result['lost_calls'],
+                sum(result['errors'].values())), file=sys.stderr)
+            for method in ('cache_function', 'cache_get_or_compute'):
+                result = herd(mode, count, args.herd_keys, method)
+                results['herd'].append(result)
+                print("%-9s %3d  %-20s  computations %d for %d keys, max %d per key" % (
+                    mode, count, method, result['computations'], result['keys'], result['max_per_key']),
+                    file=sys.stderr)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    failed = any(r['errors'] for r in results['mixed'] + results['herd'])
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,8 +23,17 @@ More info below about parameters.
 # will be used as keys and cache_set/cache_get will use different keys that
 # would cause serious problems.)
 
+import functools
+import inspect
 import logging
+import os
 import pickle as pickle
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
 from hashlib import md5
 from warnings import warn
 
@@ -32,8 +41,12 @@ from django.conf import settings
 from django.core.cache import caches, InvalidCacheBackendError, DEFAULT_CACHE_ALIAS
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.encoding import smart_str
+from keyedcache import accounting, hotkeys, metrics, shared, snapshot, timing
+from keyedcache.backends import LocalObjectCache
 from keyedcache.utils import is_string_like, is_list_or_tuple
 
+default_app_config = 'keyedcache.apps.KeyedcacheConfig'
+
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 log.addHandler(logging.NullHandler())
@@ -48,16 +61,64 @@ log.addHandler(logging.NullHandler())
 CACHED_KEYS = {}
 CACHE_CALLS = 0
 CACHE_HITS = 0
+# Hits split by the tier which answered them.
+TIER_HITS = {'deferred': 0, 'request': 0, 'shared': 0, 'backend': 0, 'snapshot': 0}
+# Backend calls split by the cache alias, see KEYEDCACHE_ROUTES.
+ALIAS_STATS = {}
+# Results of cache_function by the function name: {name: {'hits', 'computed',
+# 'admitted', 'rejected', 'bypassed', 'seconds', 'bytes'}}, see cache_function.
+FUNCTION_STATS = {}
 
 KEY_DELIM = "::"
 REQUEST_CACHE = {'enabled': False}
 
 cache, cache_alias, CACHE_TIMEOUT, _CACHE_ENABLED = 4 * (None,)
+_TIMING_ENABLED = False
+_METRICS_INTERVAL = 0
+_HOTKEY_SAMPLE = 0.0
+
+# Admission of cache_function results, see KEYEDCACHE_MIN_COMPUTE.
+_MIN_COMPUTE = 0.0
+_MAX_BYTES_PER_MS = 0
+
+# Replication of hot keys, see cache_replica_keys.
+_REPLICAS = 1
+_REPLICATED_KEYS = ()
+_REPLICATE_HOT = 0
+_REPLICA_TIMEOUT = 60
+_hot_replicated = frozenset()
+_hot_refresh = 0
+
+# (prefix, prefix + KEY_DELIM, alias, cache) sorted from the longest prefix.
+_ROUTES = ()
+
+# The tier shared by the processes of this host, see keyedcache.shared.
+_SHARED = None
+
+# Deleting all keys increments the epoch stored under EPOCH_KEY, which is
+# a part of the version of all keys, see cache_epoch.
+EPOCH_KEY = KEY_DELIM.join(('keyedcache', 'epoch'))
+_EPOCH_REFRESH = 1.0
+_epoch = 0
+_epoch_refresh = 0
+_DELETE_CHUNK = 1000
+
+# Writes buffered by cache_deferred in this thread: {key: (value, length)} or
+# {key: _DELETED}. The attribute ``writes`` is None outside of cache_deferred.
+_deferred = threading.local()
+_DELETED = object()
+
+# Loads in progress in this process: {key: Future}, see cache_get_or_compute.
+_inflight = {}
+_inflight_lock = threading.Lock()
 
 
 def keyedcache_configure():
     "Initial configuration (or reconfiguration during tests)."
-    global cache, cache_alias, CACHE_TIMEOUT, _CACHE_ENABLED
+    global cache, cache_alias, CACHE_TIMEOUT, _CACHE_ENABLED, _TIMING_ENABLED, _METRICS_INTERVAL, _HOTKEY_SAMPLE
+    global _REPLICAS, _REPLICATED_KEYS, _REPLICATE_HOT, _REPLICA_TIMEOUT, _hot_replicated, _hot_refresh
+    global _ROUTES, _MIN_COMPUTE, _MAX_BYTES_PER_MS, _SHARED
+    global _EPOCH_REFRESH, _epoch, _epoch_refresh, _DELETE_CHUNK
     cache_alias = getattr(settings, 'KEYEDCACHE_ALIAS', DEFAULT_CACHE_ALIAS)
     try:
         cache = caches[cache_alias]
@@ -71,6 +132,48 @@ def keyedcache_configure():
         log.warn("disabling the cache system because TIMEOUT=0")
 
     _CACHE_ENABLED = CACHE_TIMEOUT > 0 and not cache.__module__.endswith('dummy')
+    _TIMING_ENABLED = getattr(settings, 'KEYEDCACHE_TIMING', False)
+    timing.SLOW_CALL = getattr(settings, 'KEYEDCACHE_SLOW_CALL', 0.1)
+    _METRICS_INTERVAL = getattr(settings, 'KEYEDCACHE_METRICS_INTERVAL', 0)
+    _HOTKEY_SAMPLE = hotkeys.SAMPLE = getattr(settings, 'KEYEDCACHE_HOTKEY_SAMPLE', 0.0)
+    hotkeys.CAPACITY = getattr(settings, 'KEYEDCACHE_HOTKEY_CAPACITY', 100)
+    hotkeys.WINDOW = getattr(settings, 'KEYEDCACHE_HOTKEY_WINDOW', 300)
+    hotkeys.reset()
+
+    _REPLICAS = getattr(settings, 'KEYEDCACHE_REPLICAS', 1)
+    _REPLICATED_KEYS = tuple(getattr(settings, 'KEYEDCACHE_REPLICATED_KEYS', ()))
+    _REPLICATE_HOT = getattr(settings, 'KEYEDCACHE_REPLICATE_HOT', 0)
+    _REPLICA_TIMEOUT = getattr(settings, 'KEYEDCACHE_REPLICA_TIMEOUT', 60)
+    _hot_replicated, _hot_refresh = frozenset(), 0
+    if _REPLICATE_HOT and not _HOTKEY_SAMPLE:
+        log.warning("KEYEDCACHE_REPLICATE_HOT has no effect without KEYEDCACHE_HOTKEY_SAMPLE")
+
+    routes = []
+    for prefix, alias in getattr(settings, 'KEYEDCACHE_ROUTES', {}).items():
+        try:
+            routes.append((prefix, prefix + KEY_DELIM, alias, caches[alias]))
+        except InvalidCacheBackendError:
+            raise ImproperlyConfigured("KEYEDCACHE_ROUTES: unknown cache alias '%s' for '%s'" % (alias, prefix))
+    _ROUTES = tuple(sorted(routes, key=lambda route: -len(route[0])))
+    ALIAS_STATS.clear()
+
+    _MIN_COMPUTE = getattr(settings, 'KEYEDCACHE_MIN_COMPUTE', 0.0)
+    _MAX_BYTES_PER_MS = getattr(settings, 'KEYEDCACHE_MAX_BYTES_PER_MS', 0)
+    FUNCTION_STATS.clear()
+
+    _EPOCH_REFRESH = getattr(settings, 'KEYEDCACHE_EPOCH_REFRESH', 1.0)
+    _epoch, _epoch_refresh = 0, 0
+    _DELETE_CHUNK = getattr(settings, 'KEYEDCACHE_DELETE_CHUNK', 1000)
+
+    if _SHARED is not None:
+        _SHARED.close()
+        _SHARED = None
+    shared_path = getattr(settings, 'KEYEDCACHE_SHARED_TIER', None)
+    if shared_path:
+        _SHARED = shared.SharedTier(shared_path,
+                                    slots=getattr(settings, 'KEYEDCACHE_SHARED_SLOTS', 4096),
+                                    slot_size=getattr(settings, 'KEYEDCACHE_SHARED_SLOT_SIZE', 4096),
+                                    timeout=getattr(settings, 'KEYEDCACHE_SHARED_TIMEOUT', 10))
 
     if not cache.key_prefix and (hasattr(settings, 'CACHE_PREFIX') or settings.SITE_ID != 1):
         if hasattr(settings, 'CACHE_PREFIX'):
@@ -81,7 +184,7 @@ def keyedcache_configure():
                     "differentiate caches or to explicitely confirm they should be shared.\n"
                     " An easy solution is \"'CACHE_PREFIX': str(settings.SITE_ID)\".")
             warn("An explicit KEY_PREFIX should be defined if you use multiple sites.\n%s" % hint)
-        if not cache.__module__.split('.')[-1] in ('locmem', 'dummy'):
+        if not (cache.__module__.split('.')[-1] in ('locmem', 'dummy') or isinstance(cache, LocalObjectCache)):
             raise ImproperlyConfigured(
                 "Setting KEY_PREFIX is obligatory for production caches. See the previous warning.")
 
@@ -90,9 +193,11 @@ keyedcache_configure()
 
 
 class CacheWrapper(object):
-    def __init__(self, val, inprocess=False):
+    def __init__(self, val, inprocess=False, tags=None):
         self.val = val
         self.inprocess = inprocess
+        # {tag key: tag version} valid when the object was cached, or None
+        self.tags = tags
 
     def __str__(self):
         return str(self.val)
@@ -137,9 +242,11 @@ def cache_delete(*keys, **kwargs):
             Unknown key=val is interpreted like two aditional keys: (key, val)
 
     If no keys are present, all cached objects are to be deleted.
-    Deleting multiple multiple or all objects is usually not complete if the
-    project is running with multiple worker processes.
-    (It is reliable e.g. with a development server.)
+    Deleting children is usually not complete if the project is running with
+    multiple worker processes, because only the children registered by this
+    process are known. (It is reliable e.g. with a development server.)
+    Deleting all objects increments the epoch (see ``cache_epoch``), which is
+    complete for all processes after ``KEYEDCACHE_EPOCH_REFRESH`` seconds.
     """
     removed = []
     if cache_enabled():
@@ -149,30 +256,20 @@ def cache_delete(*keys, **kwargs):
 
         if (keys or kwargs):
             key = cache_key(*keys, **kwargs)
-
-            if key in CACHED_KEYS:
-                del CACHED_KEYS[key]
-                removed.append(key)
-
-            cache.delete(key)
-
+            names = [key]
             if children:
-                key = key + KEY_DELIM
-                children = [x for x in list(CACHED_KEYS.keys()) if x.startswith(key)]
-                for k in children:
-                    del CACHED_KEYS[k]
-                    cache.delete(k)
-                    removed.append(k)
+                prefix = key + KEY_DELIM
+                names.extend(x for x in list(CACHED_KEYS.keys()) if x.startswith(prefix))
+            removed = cache_delete_many(names)
         else:
             key = "All Keys"
-            deleteneeded = _cache_flush_all()
-
+            if getattr(_deferred, 'writes', None):
+                _deferred.writes.clear()
+            snapshot.discard()
+            if _SHARED is not None:
+                _SHARED.clear()
+            cache_epoch_increment()
             removed = list(CACHED_KEYS.keys())
-
-            if deleteneeded:
-                for k in CACHED_KEYS:
-                    cache.delete(k)
-
             CACHED_KEYS = {}
 
         if removed:
@@ -184,7 +281,18 @@ def cache_delete(*keys, **kwargs):
 
 
 def cache_delete_function(func):
-    return cache_delete(['func', func.__name__, func.__module__], children=True)
+    rejected = getattr(func, 'rejected', None)
+    if rejected is not None:
+        rejected.clear()
+    memo = getattr(func, 'local_memo', None)
+    if memo is not None:
+        memo.clear()
+        return []
+    return cache_delete(['func', _func_name(func), func.__module__], children=True)
+
+
+def _func_name(func):
+    return getattr(func, '__qualname__', func.__name__)
 
 
 def cache_enabled():
@@ -197,14 +305,396 @@ def cache_enable(state=True):
     _CACHE_ENABLED = state
 
 
-def _cache_flush_all():
-    if is_memcached_backend():
-        cache._cache.flush_all()
+def cache_epoch(refresh=False):
+    """The epoch of keyedcache, incremented by deleting all keys.
+
+    The epoch is stored in the backend and read again by every process at
+    most once per ``KEYEDCACHE_EPOCH_REFRESH`` seconds (default 1). If it was
+    evicted after this process has seen one, a new epoch (the current time)
+    is created, so that the objects of epoch 0 do not come back.
+    """
+    global _epoch, _epoch_refresh
+    now = time.time()
+    if refresh or now >= _epoch_refresh:
+        try:
+            epoch = _timed('get', EPOCH_KEY, cache.get, EPOCH_KEY) or 0
+            if not epoch and _epoch:
+                epoch = max(int(now), _epoch + 1)
+                if not _timed('set', EPOCH_KEY, cache.add, EPOCH_KEY, epoch, None):
+                    # created concurrently by another process
+                    epoch = _timed('get', EPOCH_KEY, cache.get, EPOCH_KEY) or epoch
+                log.warning("The keyedcache epoch was evicted, new epoch %d", epoch)
+            _epoch = epoch
+        except Exception as e:
+            log.warning("Could not read the keyedcache epoch: %s", e)
+        _epoch_refresh = now + _EPOCH_REFRESH
+    return _epoch
+
+
+def cache_epoch_increment():
+    """Makes all objects cached by keyedcache unreachable, in every process.
+
+    Unlike ``flush_all`` of memcached it does not touch other keys, e.g. of
+    other applications or of another ``KEY_PREFIX``. The old objects remain
+    in the backend until they expire or are evicted. The new epoch is at
+    least the current time in seconds, so that it is new also if the epoch
+    was evicted from the backend.
+    """
+    global _epoch, _epoch_refresh
+    epoch = max(cache_epoch(refresh=True) + 1, int(time.time()))
+    _timed('set', EPOCH_KEY, cache.set, EPOCH_KEY, epoch, None)
+    _epoch, _epoch_refresh = epoch, time.time() + _EPOCH_REFRESH
+    log.debug('keyedcache epoch %d', epoch)
+    return epoch
+
+
+def _version(backend):
+    """The ``version`` argument of calls of ``backend``: its VERSION and the epoch."""
+    epoch = cache_epoch()
+    if not epoch:
+        return None
+    return "%s.%d" % (backend.version, epoch)
+
+
+def cache_aliases():
+    """All (alias, cache) pairs used by keyedcache, the default one first."""
+    aliases = [(cache_alias, cache)]
+    for prefix, prefix_delim, alias, backend in _ROUTES:
+        if alias not in [a for a, b in aliases]:
+            aliases.append((alias, backend))
+    return aliases
+
+
+def cache_backend(key):
+    """The (alias, cache) pair which stores ``key``.
+
+    Keys are routed to different cache aliases by their prefix in settings::
+
+        KEYEDCACHE_ROUTES = {'config': 'local', 'blob': 'files'}
+
+    A prefix matches the key itself and all its children. The longest matching
+    prefix wins, other keys are stored in ``KEYEDCACHE_ALIAS``.
+    """
+    for prefix, prefix_delim, alias, backend in _ROUTES:
+        if key == prefix or key.startswith(prefix_delim):
+            return alias, backend
+    return cache_alias, cache
+
+
+def _alias_stats(alias):
+    try:
+        return ALIAS_STATS[alias]
+    except KeyError:
+        stats = ALIAS_STATS[alias] = {'gets': 0, 'hits': 0, 'sets': 0, 'deletes': 0}
+        return stats
+
+
+def _timed(op, key, func, *args, **kwargs):
+    """Calls the backend method ``func`` and records its latency if enabled."""
+    account = getattr(accounting.local, 'current', None)
+    if not _TIMING_ENABLED and account is None:
+        return func(*args, **kwargs)
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        if _TIMING_ENABLED:
+            timing.record(op, key.split(KEY_DELIM, 1)[0], key, elapsed)
+        if account is not None:
+            account.record(op, elapsed)
+
+
+def _pickled_size(obj):
+    try:
+        return len(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
+
+
+def cache_replica_keys(key):
+    """Names under which ``key`` is stored, the first one is the key itself.
+
+    Keys configured by ``KEYEDCACHE_REPLICATED_KEYS`` (with their children) and,
+    if ``KEYEDCACHE_REPLICATE_HOT`` is set, keys requested more often than that
+    many times per second are written ``KEYEDCACHE_REPLICAS`` times under
+    suffixed names, which are hashed to different memcached servers.
+    """
+    global _hot_replicated, _hot_refresh
+    if _REPLICAS < 2:
+        return [key]
+    replicated = False
+    for prefix in _REPLICATED_KEYS:
+        if key == prefix or key.startswith(prefix + KEY_DELIM):
+            replicated = True
+            break
+    if not replicated and _REPLICATE_HOT:
+        if time.time() >= _hot_refresh:
+            _hot_replicated = frozenset(
+                x['key'] for x in hotkeys.top(hotkeys.CAPACITY) if x['rate'] >= _REPLICATE_HOT)
+            _hot_refresh = time.time() + 10
+        replicated = key in _hot_replicated
+    if not replicated:
+        return [key]
+    return [key] + ["%s@r%d" % (key, i) for i in range(1, _REPLICAS)]
+
+
+def _backend_get(key):
+    alias, backend = cache_backend(key)
+    stats = _alias_stats(alias)
+    stats['gets'] += 1
+    obj = None
+    version = _version(backend)
+    replica = key
+    replicas = cache_replica_keys(key)
+    if len(replicas) > 1:
+        replica = random.choice(replicas)
+        if replica != key:
+            obj = _timed('get', key, backend.get, replica, version=version)
+    if obj is None:
+        obj = _timed('get', key, backend.get, key, version=version)
+        if obj is not None and replica != key:
+            # The replica expired or the key became hot after it was written.
+            _timed('set', key, backend.add, replica, obj, _REPLICA_TIMEOUT, version=version)
+    if obj is not None:
+        stats['hits'] += 1
+    return obj
+
+
+def _shared_discard(key):
+    # Called after the backend write: a concurrent cache_get which read the
+    # old object before it sees the changed slot and does not store it.
+    if _SHARED is not None:
+        _SHARED.delete(key)
+
+
+def _backend_set(key, val, length):
+    # the snapshot value must not come back when the new one expires
+    snapshot.discard([key])
+    alias, backend = cache_backend(key)
+    _alias_stats(alias)['sets'] += 1
+    version = _version(backend)
+    replicas = cache_replica_keys(key)
+    if len(replicas) == 1:
+        _timed('set', key, backend.set, key, val, length, version=version)
+        stale = _delete_names(key)[1:]
+        if stale:
+            # Replicas written while the key was hot, maybe in another process.
+            _timed('delete', key, backend.delete_many, stale, version=version)
+    elif _replica_timeout(length) == length:
+        _timed('set', key, backend.set_many, dict.fromkeys(replicas, val), length, version=version)
+    else:
+        _timed('set', key, backend.set_many, dict.fromkeys(replicas[1:], val), _REPLICA_TIMEOUT, version=version)
+        _timed('set', key, backend.set, key, val, length, version=version)
+    _shared_discard(key)
+
+
+def _replica_timeout(length):
+    # Replicas are written with a short timeout, so that keys which are no
+    # longer hot do not keep them in the backend.
+    if length is not None and length <= _REPLICA_TIMEOUT:
+        return length
+    return _REPLICA_TIMEOUT
+
+
+def _delete_names(key):
+    if _REPLICATE_HOT and _REPLICAS > 1:
+        # Another process may have considered the key hot.
+        return [key] + ["%s@r%d" % (key, i) for i in range(1, _REPLICAS)]
+    return cache_replica_keys(key)
+
+
+def _backend_delete(key):
+    alias, backend = cache_backend(key)
+    _alias_stats(alias)['deletes'] += 1
+    version = _version(backend)
+    replicas = _delete_names(key)
+    if len(replicas) > 1:
+        _timed('delete', key, backend.delete_many, replicas, version=version)
+    else:
+        _timed('delete', key, backend.delete, key, version=version)
+    _shared_discard(key)
+
+
+def _delete_chunked(alias, backend, names, progress=None, done=0, total=0):
+    """Deletes ``names`` by ``delete_many`` calls of at most KEYEDCACHE_DELETE_CHUNK names."""
+    version = _version(backend)
+    for i in range(0, len(names), _DELETE_CHUNK):
+        chunk = names[i:i + _DELETE_CHUNK]
+        _alias_stats(alias)['deletes'] += len(chunk)
+        _timed('delete_many', '', backend.delete_many, chunk, version=version)
+        done += len(chunk)
+        if progress is not None:
+            progress(done, total)
+    return done
+
+
+def cache_delete_many(keys, progress=None):
+    """Deletes the objects of full ``keys``, e.g. made by ``cache_key``.
+
+    The backends are called by chunks of ``delete_many`` of at most
+    ``KEYEDCACHE_DELETE_CHUNK`` names (default 1000) and ``progress(deleted,
+    total)`` is called after every chunk. Returns the keys which were
+    registered in CACHED_KEYS. Used by ``cache_delete`` for children.
+    """
+    removed = []
+    for key in keys:
+        # another thread can delete it at the same time
+        if CACHED_KEYS.pop(key, None):
+            removed.append(key)
+    snapshot.discard(keys)
+
+    writes = getattr(_deferred, 'writes', None)
+    if writes is not None:
+        for key in keys:
+            writes[key] = _DELETED
+    elif len(keys) == 1:
+        _backend_delete(keys[0])
+    else:
+        by_alias = {}  # alias => (backend, [name, ...])
+        for key in keys:
+            alias, backend = cache_backend(key)
+            by_alias.setdefault(alias, (backend, []))[1].extend(_delete_names(key))
+        total = sum(len(names) for backend, names in by_alias.values())
+        done = 0
+        for alias, (backend, names) in by_alias.items():
+            done = _delete_chunked(alias, backend, names, progress, done, total)
+        for key in keys:
+            _shared_discard(key)
+    return removed
+
+
+@contextmanager
+def cache_deferred():
+    """Buffers ``cache_set`` and ``cache_delete`` in this thread until the end.
+
+    Writes of the same key are coalesced (the last one wins) and are visible
+    to ``cache_get`` in the same thread. At the end all buffered writes are
+    flushed by one ``set_many`` per cache alias and timeout and one
+    ``delete_many`` per cache alias. Deleting all keys is not deferred.
+
+    Usable in Celery tasks and management commands::
+
+        with keyedcache.cache_deferred():
+            ...
+
+    and for requests by ``keyedcache.middleware.DeferredWritesMiddleware``.
+    Nested blocks are flushed by the outermost one.
+    """
+    if getattr(_deferred, 'writes', None) is not None:
+        yield
+        return
+    _deferred.writes = {}
+    try:
+        yield
+    finally:
+        cache_flush_deferred()
+
+
+def cache_flush_deferred():
+    """Writes the buffer of ``cache_deferred`` to the backends."""
+    writes = getattr(_deferred, 'writes', None)
+    _deferred.writes = None
+    if not writes:
+        return
+    snapshot.discard(writes)
+
+    sets = {}  # (alias, length) => (backend, {name: value})
+    deletes = {}  # alias => (backend, [name, ...])
+    for key, entry in writes.items():
+        alias, backend = cache_backend(key)
+        if entry is _DELETED:
+            deletes.setdefault(alias, (backend, []))[1].extend(_delete_names(key))
+            continue
+        val, length = entry
+        sets.setdefault((alias, length), (backend, {}))[1][key] = val
+        replicas = cache_replica_keys(key)
+        for replica in replicas[1:]:
+            sets.setdefault((alias, _replica_timeout(length)), (backend, {}))[1][replica] = val
+        if len(replicas) == 1:
+            deletes.setdefault(alias, (backend, []))[1].extend(_delete_names(key)[1:])
+
+    for (alias, length), (backend, data) in sets.items():
+        _alias_stats(alias)['sets'] += len(data)
+        _timed('set_many', '', backend.set_many, data, length, version=_version(backend))
+    for alias, (backend, names) in deletes.items():
+        _delete_chunked(alias, backend, names)
+    for key in writes:
+        _shared_discard(key)
+    log.debug('flushed deferred writes: %d sets, %d deletes',
+              sum(len(data) for backend, data in sets.values()),
+              sum(len(names) for backend, names in deletes.values()))
+
+
+class _LocalMemo(object):
+    """Bounded in-process map with LRU eviction and a timeout, for cache_function."""
+
+    def __init__(self, maxsize, length):
+        self.maxsize = maxsize
+        self.length = length
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            expires, value = self.data[key]
+            if self.length is not None and expires < time.time():
+                del self.data[key]
+                raise KeyError(key)
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.length if self.length is not None else None
+        with self.lock:
+            self.data[key] = (expires, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+def _canonical_arguments(signature, ignore, args, kwargs):
+    """Arguments of a call as a tuple of (name, value), with defaults applied.
+
+    ``f(1, b=2)``, ``f(1, 2)`` and ``f(1)`` (if ``b=2`` is the default) give
+    the same result.
+    """
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    canonical = []
+    for name, value in bound.arguments.items():
+        if name in ignore:
+            continue
+        kind = signature.parameters[name].kind
+        if kind == inspect.Parameter.VAR_KEYWORD:
+            value = tuple(sorted(value.items()))
+        canonical.append((name, value))
+    return tuple(canonical)
+
+
+def _function_stats(name):
+    try:
+        return FUNCTION_STATS[name]
+    except KeyError:
+        return FUNCTION_STATS.setdefault(name, {'hits': 0, 'computed': 0, 'admitted': 0, 'rejected': 0,
+                                                'bypassed': 0, 'seconds': 0.0, 'bytes': 0})
+
+
+def _admit(seconds, size, min_compute, max_bytes_per_ms):
+    """If a result computed in ``seconds`` of pickled ``size`` is worth caching."""
+    if seconds < min_compute:
+        return False
+    if max_bytes_per_ms and size > max_bytes_per_ms * seconds * 1000:
         return False
     return True
 
 
-def cache_function(length=CACHE_TIMEOUT):
+def cache_function(length=CACHE_TIMEOUT, tags=None, ignore=(), local=False, maxsize=1000,
+                   min_compute=None, max_bytes_per_ms=None):
     """
     A variant of the snippet posted by Jeff Wheeler at
     http://www.djangosnippets.org/snippets/109/
@@ -221,37 +711,183 @@ def cache_function(length=CACHE_TIMEOUT):
     threads, you won't be able to get the previous value, and will need to
     wait until the function finishes. If this is not desired behavior, you can
     remove the first two lines after the ``else``.
+
+    The arguments are bound to the signature of the function, so positional
+    and keyword forms of the same call and omitted defaults share one key.
+    The key contains ``__qualname__``, so methods and nested functions do
+    not collide.
+
+    ``tags`` is a list of tags (see ``cache_set_tagged``) or a function which
+    gets the arguments of the call and returns the list, e.g.
+    ``tags=lambda product: ['product:%s' % product.pk]``.
+
+    ``ignore`` is a list of names of arguments that do not affect the result,
+    e.g. ``ignore=['request']``.
+
+    With ``local=True`` the results of a pure function are kept in this
+    process only, at most ``maxsize`` of them, and the backend is not used.
+
+    The compute time and the pickled size of every result stored in the
+    backend are recorded in ``FUNCTION_STATS``. The result is not cached if
+    it was computed in less than ``min_compute`` seconds or if it has more
+    than ``max_bytes_per_ms`` bytes per millisecond of the compute time.
+    The defaults are the settings ``KEYEDCACHE_MIN_COMPUTE`` (0) and
+    ``KEYEDCACHE_MAX_BYTES_PER_MS`` (0, no limit). Arguments of a result
+    which was not cached are remembered in the process for ``length``
+    seconds (at most ``maxsize`` of them) and their next calls go directly
+    to the function, without the backend.
     """
+    if local and tags is not None:
+        raise ValueError("Tags can not invalidate results cached with local=True")
 
     def decorator(func):
+        name = _func_name(func)
+        full_name = ".".join([func.__module__, name])
+        try:
+            signature = inspect.signature(func)
+        except (TypeError, ValueError):
+            signature = None
+
+        def func_key(args, kwargs):
+            if signature is not None:
+                try:
+                    return _canonical_arguments(signature, ignore, args, kwargs)
+                except TypeError:
+                    pass  # a wrong call, ``func`` will raise
+            return (args, tuple(sorted(kwargs.items())))
+
+        def memo_key(key):
+            try:
+                hash(key)
+            except TypeError:
+                key = md5_hash(key)
+            return key
+
+        memo = _LocalMemo(maxsize, length) if local else None
+        # Arguments whose results were not admitted: {memo key: None}
+        rejected = _LocalMemo(maxsize, length)
+
+        @functools.wraps(func)
         def inner_func(*args, **kwargs):
             if not cache_enabled():
                 value = func(*args, **kwargs)
 
+            elif local:
+                key = memo_key(func_key(args, kwargs))
+                try:
+                    value = memo.get(key)
+                except KeyError:
+                    value = func(*args, **kwargs)
+                    memo.set(key, value)
+
             else:
+                stats = _function_stats(full_name)
+                key = func_key(args, kwargs)
                 try:
-                    value = cache_get('func', func.__name__, func.__module__, args, kwargs)
+                    rejected.get(memo_key(key))
+                except KeyError:
+                    pass
+                else:
+                    # not worth the backend calls, see min_compute
+                    stats['bypassed'] += 1
+                    return func(*args, **kwargs)
+                try:
+                    value = cache_get('func', name, func.__module__, key)
+                    stats['hits'] += 1
 
                 except NotCachedError as e:
                     # This will set a temporary value while ``func`` is being
                     # processed. When using threads, this is vital, as otherwise
                     # the function can be called several times before it finishes
                     # and is put into the cache.
-                    funcwrapper = CacheWrapper(".".join([func.__module__, func.__name__]), inprocess=True)
+                    funcwrapper = CacheWrapper(full_name, inprocess=True)
                     cache_set(e.key, value=funcwrapper, length=length, skiplog=True)
+                    start = time.perf_counter()
                     value = func(*args, **kwargs)
-                    cache_set(e.key, value=value, length=length)
+                    seconds = time.perf_counter() - start
+                    size = _pickled_size(value)
+                    stats['computed'] += 1
+                    stats['seconds'] += seconds
+                    stats['bytes'] += size
+                    if not _admit(seconds, size,
+                                  _MIN_COMPUTE if min_compute is None else min_compute,
+                                  _MAX_BYTES_PER_MS if max_bytes_per_ms is None else max_bytes_per_ms):
+                        stats['rejected'] += 1
+                        log.debug('not caching %s: %.1f ms, %d bytes', e.key, seconds * 1000, size)
+                        cache_delete(e.key)
+                        rejected.set(memo_key(key), None)
+                    elif tags is None:
+                        stats['admitted'] += 1
+                        cache_set(e.key, value=value, length=length)
+                    else:
+                        stats['admitted'] += 1
+                        value_tags = tags(*args, **kwargs) if callable(tags) else tags
+                        cache_set_tagged(value_tags, e.key, value=value, length=length)
 
                 except MethodNotFinishedError as e:
                     value = func(*args, **kwargs)
 
             return value
 
+        inner_func.local_memo = memo
+        inner_func.rejected = rejected
         return inner_func
 
     return decorator
 
 
+def cache_get_or_compute(keys, loader, length=CACHE_TIMEOUT):
+    """Gets the object identified by ``keys`` or caches the result of ``loader()``.
+
+    keys:
+        A key or a list or tuple of key parts, as for ``cache_key``.
+    loader:
+        A function without arguments which computes the object on a miss.
+        Its exceptions are propagated and nothing is cached.
+    length:
+        Timeout for the object. Default is CACHE_TIMEOUT.
+
+    Threads of this process that miss the same key at the same time share
+    one call of ``loader`` and all get its result (or its exception).
+    """
+    key = cache_key(keys)
+    try:
+        return cache_get(key)
+    except (NotCachedError, MethodNotFinishedError):
+        pass
+
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+    if not leader:
+        log.debug('waiting for the load of %s', key)
+        return future.result()
+
+    try:
+        try:
+            # the previous leader may have finished since the miss above
+            value = cache_get(key)
+        except (NotCachedError, MethodNotFinishedError):
+            value = loader()
+            cache_set(key, value=value, length=length)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(value)
+        return value
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+
+def cache_hot_keys(n=10):
+    """The ``n`` most requested keys of this process, see keyedcache.hotkeys."""
+    return hotkeys.top(n)
+
+
 def cache_get(*keys, **kwargs):
     """
     Gets the object identified by all ``keys`` from the cache.
@@ -279,9 +915,14 @@ def cache_get(*keys, **kwargs):
         CACHE_CALLS += 1
         if CACHE_CALLS == 1:
             cache_require()
+        if _METRICS_INTERVAL and time.time() >= metrics.next_publish:
+            metrics.publish(_METRICS_INTERVAL)
+        if _HOTKEY_SAMPLE and random.random() < _HOTKEY_SAMPLE:
+            hotkeys.record(key)
 
         obj = None
         tid = -1
+        tier = 'request'
         if REQUEST_CACHE['enabled']:
             # tid = cache_get_request_uid()
             if tid > -1:
@@ -291,11 +932,37 @@ def cache_get(*keys, **kwargs):
                 except KeyError:
                     pass
 
-        if obj == None:
-            obj = cache.get(key)
-
-        if obj and isinstance(obj, CacheWrapper):
+        writes = getattr(_deferred, 'writes', None)
+        if obj == None and writes and key in writes:
+            tier = 'deferred'
+            entry = writes[key]
+            obj = None if entry is _DELETED else entry[0]
+        elif obj == None:
+            if _SHARED is not None:
+                tier = 'shared'
+                obj = _SHARED.get(key)
+            if obj is None:
+                tier = 'backend'
+                sequence = _SHARED.sequence(key) if _SHARED is not None else None
+                obj = _backend_get(key)
+                if _SHARED is not None and isinstance(obj, CacheWrapper) and not obj.inprocess:
+                    # not if a write of this host discarded the key meanwhile
+                    _SHARED.set(key, obj, sequence)
+            if obj is None and snapshot.pending:
+                tier = 'snapshot'
+                obj = snapshot.load_pending(key)
+
+        hit = bool(obj and isinstance(obj, CacheWrapper) and (
+            not getattr(obj, 'tags', None) or _tag_versions_current(obj.tags)))
+        account = getattr(accounting.local, 'current', None)
+        if account is not None:
+            account.get(key.split(KEY_DELIM, 1)[0], hit)
+            if hit and account.count_bytes:
+                account.bytes += _pickled_size(obj)
+
+        if hit:
             CACHE_HITS += 1
+            TIER_HITS[tier] += 1
             CACHED_KEYS[key] = True
             log.debug('got cached [%i/%i]: %s', CACHE_CALLS, CACHE_HITS, key)
             if obj.inprocess:
@@ -316,6 +983,56 @@ def cache_get(*keys, **kwargs):
             raise NotCachedError(key)
 
 
+def cache_get_many(keys):
+    """Gets the objects identified by ``keys``, a list of keys made by ``cache_key``.
+
+    One backend call is made per cache alias. Returns a dict {key: object}
+    with the found objects only.
+    """
+    found = {}
+    if not cache_enabled():
+        return found
+    global CACHE_CALLS, CACHE_HITS
+    CACHE_CALLS += len(keys)
+
+    writes = getattr(_deferred, 'writes', None)
+    objs = {}
+    deferred = set()
+    by_alias = {}
+    for key in keys:
+        if writes and key in writes:
+            entry = writes[key]
+            if entry is not _DELETED:
+                objs[key] = entry[0]
+                deferred.add(key)
+        else:
+            alias, backend = cache_backend(key)
+            by_alias.setdefault(alias, (backend, []))[1].append(key)
+
+    for alias, (backend, alias_keys) in by_alias.items():
+        stats = _alias_stats(alias)
+        alias_keys = list(OrderedDict.fromkeys(alias_keys))
+        stats['gets'] += len(alias_keys)
+        alias_objs = _timed('get_many', alias_keys[0], backend.get_many, alias_keys, version=_version(backend))
+        stats['hits'] += len(alias_objs)
+        objs.update(alias_objs)
+
+    for key, obj in objs.items():
+        if (isinstance(obj, CacheWrapper) and not obj.inprocess and
+                (not getattr(obj, 'tags', None) or _tag_versions_current(obj.tags))):
+            CACHE_HITS += 1
+            TIER_HITS['deferred' if key in deferred else 'backend'] += 1
+            CACHED_KEYS[key] = True
+            found[key] = obj.val
+    account = getattr(accounting.local, 'current', None)
+    if account is not None:
+        account.batch(len(found), len(keys) - len(found))
+        if account.count_bytes:
+            account.bytes += sum(_pickled_size(objs[key]) for key in found)
+    log.debug('got many cached [%i/%i]', len(found), len(keys))
+    return found
+
+
 def cache_set(*keys, **kwargs):
     """Set the object identified by all ``keys`` into the cache.
 
@@ -339,12 +1056,80 @@ def cache_set(*keys, **kwargs):
         val = CacheWrapper.wrap(obj)
         if not skiplog:
             log.debug('setting cache: %s', key)
-        cache.set(key, val, length)
+        account = getattr(accounting.local, 'current', None)
+        if account is not None and account.count_bytes:
+            account.bytes += _pickled_size(val)
+        writes = getattr(_deferred, 'writes', None)
+        if writes is not None:
+            writes[key] = (val, length)
+        else:
+            _backend_set(key, val, length)
         CACHED_KEYS[key] = True
         if REQUEST_CACHE['enabled']:
             cache_set_request(key, val)
 
 
+def cache_set_tagged(tags, *keys, **kwargs):
+    """Set the object identified by all ``keys`` into the cache with ``tags``.
+
+    The object is not found by ``cache_get`` after any of the ``tags`` has been
+    invalidated by ``cache_invalidate_tag``, even if its key is unrelated to
+    the tag. Other parameters are the same as for ``cache_set``.
+
+    Example:
+        cache_set_tagged(['product:123'], 'category', 5, 'listing', value=html)
+        cache_invalidate_tag('product:123')
+    """
+    if cache_enabled():
+        if is_string_like(tags):
+            tags = [tags]
+        kwargs['value'] = CacheWrapper(kwargs['value'], tags=cache_tag_versions(tags))
+        cache_set(*keys, **kwargs)
+
+
+def cache_invalidate_tag(*tags):
+    """Invalidates all objects cached with any of ``tags``, in all processes.
+
+    The cost does not depend on the number of tagged objects: only the version
+    of each tag stored in the backend is replaced. The objects expire later.
+    """
+    if cache_enabled():
+        versions = dict((_tag_key(tag), _new_tag_version()) for tag in tags)
+        log.debug('invalidating tags: %s', tags)
+        _timed('tags', 'keyedcache', cache.set_many, versions, None)
+
+
+def cache_tag_versions(tags):
+    """Current versions of ``tags`` as a dict {tag key: version}.
+
+    Versions are created for tags that have none yet. They are stored without
+    timeout in the ``KEYEDCACHE_ALIAS`` cache. If a version is evicted, all
+    objects with the tag are invalidated, which is safe.
+    """
+    tag_keys = [_tag_key(tag) for tag in tags]
+    versions = _timed('tags', 'keyedcache', cache.get_many, tag_keys)
+    for tag_key in tag_keys:
+        if tag_key not in versions:
+            version = _new_tag_version()
+            if not cache.add(tag_key, version, None):
+                # created concurrently by another process
+                version = cache.get(tag_key, version)
+            versions[tag_key] = version
+    return versions
+
+
+def _tag_key(tag):
+    return cache_key('keyedcache', 'tag', tag)
+
+
+def _new_tag_version():
+    return random.getrandbits(63)
+
+
+def _tag_versions_current(tags):
+    return _timed('tags', 'keyedcache', cache.get_many, list(tags)) == tags
+
+
 def _hash_or_string(key):
     if is_string_like(key) or isinstance(key, (int, float)):
         return smart_str(key)
@@ -377,9 +1162,45 @@ def md5_hash(obj):
     return md5(pickled).hexdigest()
 
 
-def is_memcached_backend():
+def cache_key_info(key):
+    """Size and remaining time of a cached object, where the backend can report it.
+
+    Returns a dict with ``size`` (bytes of the serialized object, which is
+    computed for LocalObjectCache) and ``ttl``
+    (seconds, None for no timeout). Values unknown for the backend of the key,
+    e.g. memcached, are reported as None and so is a missing object.
+    """
+    backend = cache_backend(key)[1]
+    module = backend.__module__.split('.')[-1]
+    info = {'size': None, 'ttl': None}
+    try:
+        version = _version(backend)
+        if isinstance(backend, LocalObjectCache):
+            entry = backend._entry(key, version)
+            if entry is not None:
+                info['size'] = _pickled_size(entry[0])
+                info['ttl'] = None if entry[1] is None else max(0, entry[1] - time.time())
+        elif module == 'locmem':
+            internal_key = backend.make_key(key, version)
+            pickled = backend._cache.get(internal_key)
+            if pickled is not None:
+                info['size'] = len(pickled)
+                expires = backend._expire_info.get(internal_key)
+                info['ttl'] = None if expires is None else max(0, expires - time.time())
+        elif module == 'filebased':
+            fname = backend._key_to_file(key, version)
+            with open(fname, 'rb') as f:
+                expires = pickle.load(f)
+            info['size'] = os.path.getsize(fname)
+            info['ttl'] = None if expires is None else max(0, expires - time.time())
+    except (OSError, EOFError, AttributeError, pickle.UnpicklingError):
+        pass
+    return info
+
+
+def is_memcached_backend(backend=None):
     try:
-        return cache._cache.__module__.endswith('memcache')
+        return (backend or cache)._cache.__module__.endswith('memcache')
     except AttributeError:
         return False
 
@@ -387,9 +1208,15 @@ def is_memcached_backend():
 def cache_require():
     """Error if keyedcache isn't running."""
     if cache_enabled():
-        key = cache_key('require_cache')
-        cache_set(key, value='1')
-        v = cache_get(key, default='0')
+        # a deferred write would not test the backend
+        writes = getattr(_deferred, 'writes', None)
+        _deferred.writes = None
+        try:
+            key = cache_key('require_cache')
+            cache_set(key, value='1')
+            v = cache_get(key, default='0')
+        finally:
+            _deferred.writes = writes
         if v != '1':
             raise CacheNotRespondingError()
         else:
@@ -0,0 +1,74 @@
+"""Attribution of keyedcache operations to the current request.
+
+See keyedcache.middleware.RequestAccountingMiddleware. The account of the
+current thread is kept in ``local.current``, None when not accounting.
+"""
+import threading
+
+local = threading.local()
+
+
+class RequestAccount(object):
+    """Counters of keyedcache operations made while handling one request."""
+
+    def __init__(self, count_bytes=False):
+        self.count_bytes = count_bytes
+        self.ops = {}  # backend operation => [calls, seconds]
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self.single_gets = {}  # key prefix => cache_get calls
+
+    def record(self, op, seconds):
+        try:
+            stats = self.ops[op]
+        except KeyError:
+            stats = self.ops[op] = [0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+
+    def get(self, prefix, hit):
+        self.single_gets[prefix] = self.single_gets.get(prefix, 0) + 1
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def batch(self, hits, misses):
+        self.hits += hits
+        self.misses += misses
+
+    def nplus1(self, threshold):
+        """Key prefixes read by at least ``threshold`` single-key gets."""
+        return sorted(prefix for prefix, count in self.single_gets.items() if count >= threshold)
+
+    def server_timing(self, threshold=None):
+        """The value of a ``Server-Timing`` header."""
+        metrics = []
+        for op, (calls, seconds) in sorted(self.ops.items()):
+            metrics.append('kc-%s;dur=%.2f;desc="%d calls"' % (op, seconds * 1000, calls))
+        metrics.append('kc;desc="hits=%d misses=%d bytes=%d"' % (self.hits, self.misses, self.bytes))
+        if threshold:
+            for prefix in self.nplus1(threshold):
+                metrics.append('kc-nplus1;desc="%s x%d"' % (prefix.replace('"', "'"), self.single_gets[prefix]))
+        return ', '.join(metrics)
+
+    def as_dict(self):
+        return {
+            'ops': dict((op, {'calls': calls, 'ms': round(seconds * 1000, 3)})
+                        for op, (calls, seconds) in self.ops.items()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes': self.bytes,
+        }
+
+
+def start(count_bytes=False):
+    local.current = RequestAccount(count_bytes)
+    return local.current
+
+
+def stop():
+    account = getattr(local, 'current', None)
+    local.current = None
+    return account
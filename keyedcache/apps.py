@@ -0,0 +1,25 @@
+import atexit
+import logging
+import os
+
+from django.apps import AppConfig
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+
+class KeyedcacheConfig(AppConfig):
+    name = 'keyedcache'
+
+    def ready(self):
+        # Shared backends are restored once by the keyedcache_restore
+        # command, not by every worker which starts.
+        path = getattr(settings, 'KEYEDCACHE_SNAPSHOT', None)
+        if path:
+            from keyedcache import snapshot
+            if os.path.exists(path):
+                try:
+                    snapshot.restore(path, lazy=True, local_only=True)
+                except (OSError, ValueError) as e:
+                    log.warning("Could not restore keyedcache snapshot %s: %s", path, e)
+            atexit.register(snapshot.dump_at_exit, path)
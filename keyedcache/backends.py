@@ -0,0 +1,159 @@
+"""In-process cache backend which stores references to the objects, without pickling.
+
+Usable as the cache of keyedcache, e.g.::
+
+    CACHES = {
+        'objects': {
+            'BACKEND': 'keyedcache.backends.LocalObjectCache',
+            'LOCATION': 'objects',
+            'OPTIONS': {
+                'MAX_ENTRIES': 10000,
+                'STRIPES': 16,
+                'COPY_ON_READ': ['builtins.dict', 'builtins.list'],
+            },
+        },
+    }
+    KEYEDCACHE_ALIAS = 'objects'
+
+``get`` returns the same object that was given to ``set``, so cached objects
+must not be modified by the code which gets or sets them. Objects of types in
+``COPY_ON_READ`` (also inside ``keyedcache.CacheWrapper``) are deep-copied when
+they are stored and when they are read, as ``LocMemCache`` does by pickling.
+
+Keys are split to ``STRIPES`` dicts, each with its own lock, LRU order and
+``MAX_ENTRIES // STRIPES`` entries at most; the least recently used entry
+of a full stripe is evicted. Expired entries are dropped when they are read.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.utils.module_loading import import_string
+
+# Stores shared by the instances of the same LOCATION in all threads: {name: (stripes, locks)}
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class LocalObjectCache(BaseCache):
+    def __init__(self, name, params):
+        super(LocalObjectCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        stripes = options.get('STRIPES', 16)
+        self._copy_types = tuple(import_string(t) if isinstance(t, str) else t
+                                 for t in options.get('COPY_ON_READ', ()))
+        self._stripe_entries = max(1, self._max_entries // stripes)
+        with _stores_lock:
+            if name not in _stores:
+                _stores[name] = ([OrderedDict() for i in range(stripes)],
+                                 [threading.Lock() for i in range(stripes)])
+            self._stripes, self._locks = _stores[name]
+
+    def _stripe(self, key):
+        i = hash(key) % len(self._stripes)
+        return self._stripes[i], self._locks[i]
+
+    def _copy(self, value):
+        if self._copy_types:
+            from keyedcache import CacheWrapper
+            inner = value.val if isinstance(value, CacheWrapper) else value
+            if isinstance(inner, self._copy_types):
+                return copy.deepcopy(value)
+        return value
+
+    def _live(self, data, key):
+        """The entry [value, expires] of ``key`` if it is not expired, or None."""
+        entry = data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.time():
+            del data[key]
+            return None
+        return entry
+
+    def _set(self, data, key, value, timeout):
+        data[key] = [value, self.get_backend_timeout(timeout)]
+        data.move_to_end(key)
+        while len(data) > self._stripe_entries:
+            data.popitem(last=False)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        value = self._copy(value)
+        data, lock = self._stripe(key)
+        with lock:
+            if self._live(data, key) is not None:
+                return False
+            self._set(data, key, value, timeout)
+            return True
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        data, lock = self._stripe(key)
+        with lock:
+            entry = self._live(data, key)
+            if entry is None:
+                return default
+            data.move_to_end(key)
+            value = entry[0]
+        return self._copy(value)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        value = self._copy(value)
+        data, lock = self._stripe(key)
+        with lock:
+            self._set(data, key, value, timeout)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        data, lock = self._stripe(key)
+        with lock:
+            entry = self._live(data, key)
+            if entry is None:
+                return False
+            entry[1] = self.get_backend_timeout(timeout)
+            return True
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        data, lock = self._stripe(key)
+        with lock:
+            entry = self._live(data, key)
+            if entry is None:
+                raise ValueError("Key '%s' not found" % key)
+            entry[0] += delta
+            return entry[0]
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        data, lock = self._stripe(key)
+        with lock:
+            return self._live(data, key) is not None
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        data, lock = self._stripe(key)
+        with lock:
+            return data.pop(key, None) is not None
+
+    def clear(self):
+        for data, lock in zip(self._stripes, self._locks):
+            with lock:
+                data.clear()
+
+    def _entry(self, key, version=None):
+        """(object, expiration time or None) of a live ``key`` or None, for keyedcache.cache_key_info."""
+        key = self.make_key(key, version=version)
+        data, lock = self._stripe(key)
+        with lock:
+            entry = self._live(data, key)
+            return None if entry is None else tuple(entry)
@@ -0,0 +1,117 @@
+import logging
+from functools import wraps
+from hashlib import md5
+
+import keyedcache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from django.utils.translation import get_language
+from keyedcache.utils import is_list_or_tuple
+
+log = logging.getLogger(__name__)
+
+
+def keyedcache_page(length=None, prefix=None, vary_on_user=False, vary_on_language=True, vary_on_headers=()):
+    """Caches the responses of a view under a keyedcache key, with an ETag.
+
+    length:
+        Timeout of the cached response. Default is CACHE_TIMEOUT.
+    prefix:
+        A function ``prefix(request, *args, **kwargs)`` which returns the
+        object or the list of key parts the page belongs to. If it is an object
+        with ``cache_key`` (``CachedObjectMixin``), the page is its child and
+        ``obj.cache_delete()`` drops it. Default is ``['page']``.
+    vary_on_user, vary_on_language, vary_on_headers:
+        What else than the path, the query and the arguments of the view makes
+        the response different.
+
+    A request with ``If-None-Match`` matching the cached ETag (by the weak
+    comparison, or ``*``) is answered by 304 without running the view or
+    fetching the cached body. Only successful
+    GET and HEAD responses without cookies and without ``Cache-Control:
+    private`` or ``no-store`` are cached, and only if their ``Vary`` header
+    names nothing else than the vary parts selected here.
+
+    Example:
+        @keyedcache_page(3600, prefix=lambda request, slug: Product.objects.get(slug=slug))
+        def product_detail(request, slug):
+            ...
+    """
+
+    def decorator(view):
+        view_name = "%s.%s" % (view.__module__, getattr(view, '__qualname__', view.__name__))
+
+        def page_key(request, args, kwargs):
+            variant = [request.get_full_path(), args, sorted(kwargs.items())]
+            if vary_on_user:
+                variant.append(request.user.pk)
+            if vary_on_language:
+                variant.append(get_language())
+            for header in vary_on_headers:
+                variant.append(request.META.get('HTTP_' + header.upper().replace('-', '_')))
+            variant = keyedcache.md5_hash(variant)
+
+            base = prefix(request, *args, **kwargs) if prefix else ['page']
+            if hasattr(base, 'cache_key'):
+                return base.cache_key('page', view_name, variant)
+            if not is_list_or_tuple(base):
+                base = [base]
+            return keyedcache.cache_key(list(base) + ['page', view_name, variant])
+
+        @wraps(view)
+        def inner_view(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or not keyedcache.cache_enabled():
+                return view(request, *args, **kwargs)
+
+            key = page_key(request, args, kwargs)
+            etag_key = keyedcache.cache_key(key, 'etag')
+            if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+            if if_none_match:
+                etag = keyedcache.cache_get(etag_key, default=None)
+                # weak comparison, e.g. GZipMiddleware sends W/"..."
+                tags = [tag[2:] if tag.startswith('W/') else tag for tag in parse_etags(if_none_match)]
+                if etag and ('*' in tags or etag in tags):
+                    response = HttpResponseNotModified()
+                    response['ETag'] = etag
+                    return response
+
+            cached = keyedcache.cache_get(key, default=None)
+            if cached is not None:
+                status, content, headers = cached
+                response = HttpResponse(content, status=status)
+                for header, value in headers:
+                    response[header] = value
+                return response
+
+            response = view(request, *args, **kwargs)
+            vary = list(vary_on_headers)
+            if vary_on_user:
+                vary.append('Cookie')
+            if vary_on_language:
+                vary.append('Accept-Language')
+            if vary:
+                patch_vary_headers(response, vary)
+
+            cache_control = response.get('Cache-Control', '')
+            if (response.status_code != 200 or response.streaming or response.cookies or
+                    'private' in cache_control or 'no-store' in cache_control):
+                return response
+            # The key would not tell apart the variants of other headers.
+            response_vary = set(h.strip().lower() for h in response.get('Vary', '').split(',') if h.strip())
+            if response_vary - set(h.lower() for h in vary):
+                log.debug('not caching %s, it varies on %s', key, response['Vary'])
+                return response
+
+            etag = '"%s"' % md5(response.content).hexdigest()
+            response['ETag'] = etag
+            length_kwargs = {} if length is None else {'length': length}
+            keyedcache.cache_set(key, value=(response.status_code, response.content, list(response.items())),
+                                 **length_kwargs)
+            keyedcache.cache_set(etag_key, value=etag, **length_kwargs)
+            log.debug('cached page %s', key)
+            return response
+
+        return inner_view
+
+    return decorator
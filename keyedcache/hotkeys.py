@@ -0,0 +1,90 @@
+"""Detection of hot keys by a streaming heavy-hitters algorithm (Space-Saving).
+
+To enable, put this to settings.py::
+
+    KEYEDCACHE_HOTKEY_SAMPLE = 0.01     # fraction of cache_get calls sampled
+    KEYEDCACHE_HOTKEY_CAPACITY = 100    # number of counters (memory is fixed)
+    KEYEDCACHE_HOTKEY_WINDOW = 300      # seconds after which counting restarts
+
+Space-Saving keeps at most ``capacity`` counters. A new key replaces the key
+with the smallest count and inherits that count as its possible error, so
+every key more frequent than 1/capacity of the sampled traffic is guaranteed
+to be reported.
+"""
+import threading
+import time
+
+SAMPLE = 0.0
+CAPACITY = 100
+WINDOW = 300
+
+
+class SpaceSaving(object):
+    """Approximate top-K counter with a fixed number of entries."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}  # key => [count, error]
+        self.total = 0
+        self.started = time.time()
+
+    def add(self, key):
+        self.total += 1
+        try:
+            self.counters[key][0] += 1
+            return
+        except KeyError:
+            pass
+        if len(self.counters) < self.capacity:
+            self.counters[key] = [1, 0]
+        else:
+            victim = min(self.counters, key=lambda k: self.counters[k][0])
+            count = self.counters.pop(victim)[0]
+            self.counters[key] = [count + 1, count]
+
+    def top(self, n):
+        items = sorted(self.counters.items(), key=lambda item: item[1][0], reverse=True)
+        return items[:n]
+
+
+_lock = threading.Lock()
+_current = SpaceSaving(CAPACITY)
+_previous = None
+
+
+def reset():
+    global _current, _previous
+    with _lock:
+        _current = SpaceSaving(CAPACITY)
+        _previous = None
+
+
+def record(key):
+    """Counts one sampled access to ``key``."""
+    global _current, _previous
+    with _lock:
+        if time.time() - _current.started > WINDOW:
+            _previous = _current
+            _current = SpaceSaving(CAPACITY)
+        _current.add(key)
+
+
+def top(n=10):
+    """The ``n`` hottest keys with their estimated request rates.
+
+    Returns a list of dicts with ``key``, ``rate`` (calls per second, scaled
+    back by the sampling rate), ``count`` (sampled) and ``error`` (the upper
+    bound by which ``count`` can be overestimated).
+    """
+    with _lock:
+        sketch = _current
+        elapsed = time.time() - sketch.started
+        # A freshly rotated window is too short to be representative.
+        if _previous is not None and elapsed < WINDOW / 2.0:
+            sketch = _previous
+            elapsed = WINDOW
+        items = sketch.top(n)
+
+    scale = 1.0 / (SAMPLE or 1.0) / max(elapsed, 1.0)
+    return [{'key': key, 'rate': count * scale, 'count': count, 'error': error}
+            for key, (count, error) in items]
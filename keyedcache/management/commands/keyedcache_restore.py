@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from keyedcache import snapshot
+
+
+class Command(BaseCommand):
+    help = "Restores the unexpired objects of a snapshot file into the cache backends."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=getattr(settings, 'KEYEDCACHE_SNAPSHOT', None))
+        parser.add_argument('--replace', action='store_true', help="Overwrite objects which are already cached.")
+
+    def handle(self, path=None, replace=False, **options):
+        if not path:
+            raise CommandError("Give the path of the snapshot or set KEYEDCACHE_SNAPSHOT.")
+        try:
+            count = snapshot.restore(path, lazy=False, replace=replace)
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        self.stdout.write("Restored %d keys from %s" % (count, path))
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from keyedcache import snapshot
+
+
+class Command(BaseCommand):
+    help = ("Writes the cached objects to a snapshot file. The registry of keys is empty in a new process,\n"
+            "so for shared backends pass the keys in a file, e.g. the CSV export of the key browser.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=getattr(settings, 'KEYEDCACHE_SNAPSHOT', None))
+        parser.add_argument('--keys', dest='keys_file', help="File with one key per line.")
+
+    def handle(self, path=None, keys_file=None, **options):
+        if not path:
+            raise CommandError("Give the path of the snapshot or set KEYEDCACHE_SNAPSHOT.")
+        keys = None
+        if keys_file:
+            with open(keys_file) as f:
+                keys = [line.strip() for line in f if line.strip()]
+        count = snapshot.dump(path, keys)
+        self.stdout.write("Written %d keys to %s" % (count, path))
@@ -0,0 +1,183 @@
+"""Export of keyedcache metrics in the OpenMetrics (Prometheus) text format.
+
+Every worker process keeps its own counters. In order to see the whole node
+in one scrape, put this to settings.py::
+
+    KEYEDCACHE_METRICS_INTERVAL = 30   # seconds
+
+Then every worker stores a snapshot of its counters into the cache backend at
+most once per interval (checked from ``cache_get``) and the ``metrics/`` view
+sums the snapshots of all live workers on the same host. Snapshots of dead
+workers expire after three intervals. With the default ``0`` only the worker
+that answered the scrape is reported.
+"""
+import logging
+import os
+import socket
+import time
+
+import keyedcache
+from keyedcache import timing
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# The histogram is exported with one bucket per power of two only, in order
+# to keep the output small and the set of ``le`` labels stable.
+EXPORTED_BUCKETS = [b for b in timing.BUCKETS if not b & (b - 1)]
+
+HOST = socket.gethostname()
+next_publish = 0
+
+
+def worker_id():
+    return "%s:%d" % (HOST, os.getpid())
+
+
+def _index_key():
+    return keyedcache.KEY_DELIM.join(('keyedcache', 'metrics', HOST))
+
+
+def _snapshot_key(worker):
+    return keyedcache.KEY_DELIM.join(('keyedcache', 'metrics', worker))
+
+
+def snapshot():
+    """Counters of this worker process as a picklable dict."""
+    return {
+        'workers': 1,
+        'enabled': int(keyedcache.cache_enabled()),
+        'calls': keyedcache.CACHE_CALLS,
+        'hits': keyedcache.CACHE_HITS,
+        'tier_hits': dict(keyedcache.TIER_HITS),
+        'aliases': dict((alias, dict(stats)) for alias, stats in list(keyedcache.ALIAS_STATS.items())),
+        'keys': len(keyedcache.CACHED_KEYS),
+        'histograms': dict(
+            (op_prefix, (list(hist.counts), hist.count, hist.sum))
+            for op_prefix, hist in list(timing.HISTOGRAMS.items())
+        ),
+    }
+
+
+def merge(total, snap):
+    for name in ('workers', 'enabled', 'calls', 'hits', 'keys'):
+        total[name] = total.get(name, 0) + snap.get(name, 0)
+    tier_hits = total.setdefault('tier_hits', {})
+    for tier, hits in snap.get('tier_hits', {}).items():
+        tier_hits[tier] = tier_hits.get(tier, 0) + hits
+    aliases = total.setdefault('aliases', {})
+    for alias, stats in snap.get('aliases', {}).items():
+        alias_total = aliases.setdefault(alias, {})
+        for name, value in stats.items():
+            alias_total[name] = alias_total.get(name, 0) + value
+    histograms = total.setdefault('histograms', {})
+    for op_prefix, (counts, count, sum_) in snap.get('histograms', {}).items():
+        if op_prefix in histograms:
+            old_counts, old_count, old_sum = histograms[op_prefix]
+            counts = [a + b for a, b in zip(old_counts, counts)]
+            count += old_count
+            sum_ += old_sum
+        histograms[op_prefix] = (counts, count, sum_)
+    return total
+
+
+def publish(interval):
+    """Stores the snapshot of this worker into the backend.
+
+    The index of workers is updated by read-modify-write, so two workers
+    publishing at the same moment can drop each other for one interval.
+    """
+    global next_publish
+    next_publish = time.time() + interval
+    timeout = 3 * interval
+    cache = keyedcache.cache
+    me = worker_id()
+    try:
+        index = cache.get(_index_key()) or {}
+        now = time.time()
+        index = dict((w, exp) for w, exp in index.items() if exp > now)
+        index[me] = now + timeout
+        cache.set(_snapshot_key(me), snapshot(), timeout)
+        cache.set(_index_key(), index, timeout)
+    except Exception as e:
+        log.warning("Could not publish keyedcache metrics: %s", e)
+
+
+def collect():
+    """Sum of the snapshots of all live workers on this host."""
+    interval = keyedcache._METRICS_INTERVAL
+    if not interval:
+        return snapshot()
+
+    publish(interval)
+    try:
+        index = keyedcache.cache.get(_index_key()) or {}
+        snaps = keyedcache.cache.get_many([_snapshot_key(w) for w in index])
+    except Exception as e:
+        log.warning("Could not collect keyedcache metrics: %s", e)
+        return snapshot()
+
+    total = {}
+    for snap in snaps.values():
+        merge(total, snap)
+    return total or snapshot()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(snap):
+    """Renders a (merged) snapshot in the OpenMetrics text format."""
+    lines = []
+    add = lines.append
+
+    def metric(name, kind, help_text):
+        add("# TYPE %s %s" % (name, kind))
+        add("# HELP %s %s" % (name, help_text))
+
+    metric('keyedcache_workers', 'gauge', 'Worker processes included in this scrape.')
+    add("keyedcache_workers %d" % snap.get('workers', 0))
+    metric('keyedcache_enabled', 'gauge', 'Worker processes with the cache enabled.')
+    add("keyedcache_enabled %d" % snap.get('enabled', 0))
+    metric('keyedcache_calls', 'counter', 'Calls of cache_get.')
+    add("keyedcache_calls_total %d" % snap.get('calls', 0))
+    metric('keyedcache_hits', 'counter', 'Calls of cache_get which found the object.')
+    add("keyedcache_hits_total %d" % snap.get('hits', 0))
+
+    calls = snap.get('calls', 0)
+    metric('keyedcache_tier_hits', 'counter', 'Hits by the tier which answered them.')
+    for tier, hits in sorted(snap.get('tier_hits', {}).items()):
+        add('keyedcache_tier_hits_total{tier="%s"} %d' % (_escape(tier), hits))
+    metric('keyedcache_tier_hit_ratio', 'gauge', 'Hits of the tier divided by all calls.')
+    for tier, hits in sorted(snap.get('tier_hits', {}).items()):
+        add('keyedcache_tier_hit_ratio{tier="%s"} %s' % (_escape(tier), float(hits) / calls if calls else 0.0))
+
+    for name, help_text in (('gets', 'Backend get calls by cache alias.'),
+                            ('hits', 'Backend get calls by cache alias which found a value.'),
+                            ('sets', 'Backend set calls by cache alias.'),
+                            ('deletes', 'Backend delete calls by cache alias.')):
+        metric('keyedcache_alias_%s' % name, 'counter', help_text)
+        for alias, stats in sorted(snap.get('aliases', {}).items()):
+            add('keyedcache_alias_%s_total{alias="%s"} %d' % (name, _escape(alias), stats.get(name, 0)))
+
+    metric('keyedcache_registered_keys', 'gauge', 'Keys in the registry CACHED_KEYS.')
+    add("keyedcache_registered_keys %d" % snap.get('keys', 0))
+
+    metric('keyedcache_backend_latency_seconds', 'histogram', 'Latency of backend calls.')
+    for (op, prefix), (counts, count, sum_) in sorted(snap.get('histograms', {}).items()):
+        labels = 'op="%s",prefix="%s"' % (_escape(op), _escape(prefix))
+        cumulative = 0
+        i = 0
+        for bound in EXPORTED_BUCKETS:
+            while i < len(timing.BUCKETS) and timing.BUCKETS[i] <= bound:
+                cumulative += counts[i]
+                i += 1
+            add('keyedcache_backend_latency_seconds_bucket{%s,le="%s"} %d' % (labels, bound / 1e6, cumulative))
+        add('keyedcache_backend_latency_seconds_bucket{%s,le="+Inf"} %d' % (labels, count))
+        add('keyedcache_backend_latency_seconds_count{%s} %d' % (labels, count))
+        add('keyedcache_backend_latency_seconds_sum{%s} %s' % (labels, sum_))
+
+    add("# EOF")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,68 @@
+import json
+import logging
+
+import keyedcache
+from django.conf import settings
+from keyedcache import accounting
+
+log = logging.getLogger(__name__)
+
+
+class DeferredWritesMiddleware(object):
+    """Buffers the keyedcache writes of a request and flushes them at its end.
+
+    See keyedcache.cache_deferred. Add it to MIDDLEWARE in settings.py::
+
+        'keyedcache.middleware.DeferredWritesMiddleware',
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with keyedcache.cache_deferred():
+            return self.get_response(request)
+
+
+class RequestAccountingMiddleware(object):
+    """Reports the keyedcache operations of every request.
+
+    The calls and time per backend operation, hits, misses and (optionally)
+    serialized bytes are sent in a ``Server-Timing`` header. Settings::
+
+        KEYEDCACHE_ACCOUNTING_BYTES = False   # measure bytes, it costs pickling
+        KEYEDCACHE_ACCOUNTING_LOG = False     # log a JSON line per request
+        KEYEDCACHE_NPLUS1_THRESHOLD = 10      # single gets of one key prefix
+
+    A request with at least ``KEYEDCACHE_NPLUS1_THRESHOLD`` single-key gets
+    of the same key prefix, which could be one ``cache_get_many``, is flagged
+    by a warning and a ``kc-nplus1`` metric.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.count_bytes = getattr(settings, 'KEYEDCACHE_ACCOUNTING_BYTES', False)
+        self.log_requests = getattr(settings, 'KEYEDCACHE_ACCOUNTING_LOG', False)
+        self.nplus1_threshold = getattr(settings, 'KEYEDCACHE_NPLUS1_THRESHOLD', 10)
+
+    def __call__(self, request):
+        accounting.start(self.count_bytes)
+        try:
+            response = self.get_response(request)
+        finally:
+            account = accounting.stop()
+
+        timing = account.server_timing(self.nplus1_threshold)
+        if response.has_header('Server-Timing'):
+            timing = response['Server-Timing'] + ', ' + timing
+        response['Server-Timing'] = timing
+
+        nplus1 = account.nplus1(self.nplus1_threshold) if self.nplus1_threshold else []
+        if nplus1:
+            log.warning("N+1 cache access in %s: %s", request.path,
+                        ', '.join('%s x%d' % (prefix, account.single_gets[prefix]) for prefix in nplus1))
+        if self.log_requests:
+            line = account.as_dict()
+            line.update({'path': request.path, 'method': request.method, 'nplus1': nplus1})
+            log.info(json.dumps(line, sort_keys=True))
+        return response
@@ -45,16 +45,11 @@ def find_by_id(cls, groupkey, objectid, raises=False):
     """A helper function to look up an object by id"""
     ob = None
     try:
-        ob = keyedcache.cache_get(groupkey, objectid)
-    except keyedcache.NotCachedError as e:
-        try:
-            ob = cls.objects.get(pk=objectid)
-            keyedcache.cache_set(e.key, value=ob)
-
-        except cls.DoesNotExist:
-            log.debug("No such %s: %s", groupkey, objectid)
-            if raises:
-                raise cls.DoesNotExist
+        ob = keyedcache.cache_get_or_compute((groupkey, objectid), lambda: cls.objects.get(pk=objectid))
+    except cls.DoesNotExist:
+        log.debug("No such %s: %s", groupkey, objectid)
+        if raises:
+            raise cls.DoesNotExist
 
     return ob
 
@@ -63,16 +58,11 @@ def find_by_key(cls, groupkey, key, raises=False):
     """A helper function to look up an object by key"""
     ob = None
     try:
-        ob = keyedcache.cache_get(groupkey, key)
-    except keyedcache.NotCachedError as e:
-        try:
-            ob = cls.objects.get(key__exact=key)
-            keyedcache.cache_set(e.key, value=ob)
-
-        except cls.DoesNotExist:
-            log.debug("No such %s: %s", groupkey, key)
-            if raises:
-                raise
+        ob = keyedcache.cache_get_or_compute((groupkey, key), lambda: cls.objects.get(key__exact=key))
+    except cls.DoesNotExist:
+        log.debug("No such %s: %s", groupkey, key)
+        if raises:
+            raise
 
     return ob
 
@@ -81,15 +71,10 @@ def find_by_slug(cls, groupkey, slug, raises=False):
     """A helper function to look up an object by slug"""
     ob = None
     try:
-        ob = keyedcache.cache_get(groupkey, slug)
-    except keyedcache.NotCachedError as e:
-        try:
-            ob = cls.objects.get(slug__exact=slug)
-            keyedcache.cache_set(e.key, value=ob)
-
-        except cls.DoesNotExist:
-            log.debug("No such %s: %s", groupkey, slug)
-            if raises:
-                raise
+        ob = keyedcache.cache_get_or_compute((groupkey, slug), lambda: cls.objects.get(slug__exact=slug))
+    except cls.DoesNotExist:
+        log.debug("No such %s: %s", groupkey, slug)
+        if raises:
+            raise
 
     return ob
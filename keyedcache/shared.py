@@ -0,0 +1,181 @@
+"""Cache tier in a memory-mapped file shared by all worker processes of a host.
+
+Put this to settings.py::
+
+    KEYEDCACHE_SHARED_TIER = '/dev/shm/keyedcache-myproject'
+    KEYEDCACHE_SHARED_SLOTS = 4096        # entries
+    KEYEDCACHE_SHARED_SLOT_SIZE = 4096    # bytes of one entry with its key
+    KEYEDCACHE_SHARED_TIMEOUT = 10        # seconds
+
+``cache_get`` looks into the shared tier before the backend and copies the
+objects found in the backend to it. Writes and deletes of this host remove
+the key from the tier after the backend call, writes of other hosts are seen
+after the timeout. The copy is not stored if the slot changed since before
+the backend read, so an object read before a concurrent write of this host
+does not replace it.
+
+The file is a hash table of fixed size slots, one key per slot; a new key
+replaces the key in its slot. Every slot has a sequence number, which is odd
+while the slot is being written. Readers do not lock: they retry a read if
+the sequence number changed. Writers of a slot are serialized by a ``lockf``
+lock of its byte range (and a lock of the process for threads). Objects that
+do not fit into a slot are not stored.
+"""
+import fcntl
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from hashlib import blake2b
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'KCSHM001'
+HEADER = struct.Struct('<8sII')  # magic, slots, slot size
+DATA_OFFSET = 64
+SLOT = struct.Struct('<QdQII')  # sequence, expires (0 is empty), key hash, key length, value length
+SEQUENCE = struct.Struct('<Q')
+ENTRY = struct.Struct('<dQII')  # SLOT without the sequence
+READ_RETRIES = 3
+
+
+def _hash(key):
+    return struct.unpack('<Q', blake2b(key, digest_size=8).digest())[0]
+
+
+class SharedTier(object):
+    def __init__(self, path, slots=4096, slot_size=4096, timeout=10):
+        if slot_size <= SLOT.size:
+            raise ValueError("The slot size must be bigger than %d bytes" % SLOT.size)
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # Keys which could not be stored, not pickled again until the time: {key: time}
+        self.skipped = {}
+        size = DATA_OFFSET + slots * slot_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self.fd, HEADER.size, 0)
+            if len(header) < HEADER.size or HEADER.unpack(header) != (MAGIC, slots, slot_size):
+                log.debug('initializing the shared tier %s', path)
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+                os.pwrite(self.fd, HEADER.pack(MAGIC, slots, slot_size), 0)
+            self.map = mmap.mmap(self.fd, size)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def _offset(self, key_hash):
+        return DATA_OFFSET + (key_hash % self.slots) * self.slot_size
+
+    @contextmanager
+    def _locked(self, offset, length):
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, length, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, length, offset)
+
+    def get(self, key):
+        """The object stored under ``key`` or None."""
+        key = key.encode('utf-8')
+        key_hash = _hash(key)
+        offset = self._offset(key_hash)
+        data = self.map
+        for i in range(READ_RETRIES):
+            sequence, expires, slot_hash, key_len, value_len = SLOT.unpack_from(data, offset)
+            if sequence & 1:
+                continue
+            if slot_hash != key_hash or not expires or expires < time.time():
+                return None
+            start = offset + SLOT.size
+            slot_key = data[start:start + key_len]
+            value = data[start + key_len:start + key_len + value_len]
+            if SEQUENCE.unpack_from(data, offset)[0] != sequence:
+                continue
+            if slot_key != key:
+                return None
+            try:
+                return pickle.loads(value)
+            except Exception as e:
+                log.debug('unreadable object %s in the shared tier: %s', key, e)
+                return None
+        return None
+
+    def sequence(self, key):
+        """The sequence number of the slot of ``key``, for ``set``."""
+        return SEQUENCE.unpack_from(self.map, self._offset(_hash(key.encode('utf-8'))))[0]
+
+    def set(self, key, obj, sequence=None):
+        """Stores ``obj`` for the timeout of the tier.
+
+        Returns False if it does not fit or can not be pickled, or if
+        ``sequence`` is given and the slot was written or deleted since it was
+        read by ``sequence(key)``. A key which does not fit or can not be
+        pickled is not tried again by this process for the timeout.
+        """
+        key = key.encode('utf-8')
+        if self.skipped and self.skipped.get(key, 0) > time.time():
+            return False
+        try:
+            value = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            log.debug('not storing %s in the shared tier: %s', key, e)
+            value = None
+        if value is None or SLOT.size + len(key) + len(value) > self.slot_size:
+            if len(self.skipped) >= self.slots:
+                self.skipped.clear()
+            self.skipped[key] = time.time() + self.timeout
+            return False
+        key_hash = _hash(key)
+        offset = self._offset(key_hash)
+        start = offset + SLOT.size
+        with self._locked(offset, self.slot_size):
+            if sequence is not None and SEQUENCE.unpack_from(self.map, offset)[0] != sequence:
+                return False
+            sequence = self._begin(offset)
+            self.map[start:start + len(key) + len(value)] = key + value
+            ENTRY.pack_into(self.map, offset + SEQUENCE.size, time.time() + self.timeout, key_hash,
+                            len(key), len(value))
+            SEQUENCE.pack_into(self.map, offset, sequence + 1)
+        return True
+
+    def _begin(self, offset):
+        """Makes the sequence of a locked slot odd, returns it. The writer stores it + 1 last."""
+        sequence = SEQUENCE.unpack_from(self.map, offset)[0] | 1
+        SEQUENCE.pack_into(self.map, offset, sequence)
+        return sequence
+
+    def _empty(self, offset):
+        sequence = self._begin(offset)
+        ENTRY.pack_into(self.map, offset + SEQUENCE.size, 0.0, 0, 0, 0)
+        SEQUENCE.pack_into(self.map, offset, sequence + 1)
+
+    def delete(self, key):
+        """Removes ``key``. The sequence of its slot changes even if it is not there."""
+        key_hash = _hash(key.encode('utf-8'))
+        offset = self._offset(key_hash)
+        with self._locked(offset, self.slot_size):
+            sequence, expires, slot_hash, key_len, value_len = SLOT.unpack_from(self.map, offset)
+            if slot_hash == key_hash and expires:
+                self._empty(offset)
+            else:
+                sequence = self._begin(offset)
+                SEQUENCE.pack_into(self.map, offset, sequence + 1)
+
+    def clear(self):
+        with self._locked(0, 0):
+            for i in range(self.slots):
+                self._empty(DATA_OFFSET + i * self.slot_size)
@@ -0,0 +1,181 @@
+"""Snapshot of the cached objects for fast warm restarts of in-process caches.
+
+The file format is made to be memory-mapped::
+
+    header: magic, number of entries
+    index:  (expires, key offset, key length, value offset, value length) * n
+    data:   keys (utf-8) and values (pickled CacheWrapper)
+
+Restoring reads the index only. Expired entries are skipped without touching
+their values and the other values are unpickled when they are used.
+
+To snapshot every worker at exit and restore the snapshot on start, put
+this to settings.py::
+
+    KEYEDCACHE_SNAPSHOT = '/var/tmp/keyedcache.snapshot'
+
+Keys stored in process-local backends (locmem, LocalObjectCache) are restored lazily, on the
+first ``cache_get`` which misses them. Keys of shared backends are restored
+eagerly with ``add``, which never overwrites a newer value. See also the
+management commands ``keyedcache_snapshot`` and ``keyedcache_restore``.
+"""
+import logging
+import mmap
+import os
+import pickle
+import struct
+import time
+
+import keyedcache
+from keyedcache.backends import LocalObjectCache
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'KCSNAP01'
+HEADER = struct.Struct('<8sI')
+ENTRY = struct.Struct('<dIIII')
+NO_TIMEOUT = 0.0
+
+# Lazily restored entries of process-local backends: {key: (expires, mmap, offset, length)}
+pending = None
+
+
+def dump(path, keys=None):
+    """Writes the objects of ``keys`` (default: all registered keys) to ``path``.
+
+    Returns the number of written entries.
+    """
+    if keys is None:
+        keys = list(keyedcache.CACHED_KEYS)
+    now = time.time()
+    entries = []
+    for key in keys:
+        backend = keyedcache.cache_backend(key)[1]
+        obj = backend.get(key, version=keyedcache._version(backend))
+        if not isinstance(obj, keyedcache.CacheWrapper) or obj.inprocess:
+            continue
+        info = keyedcache.cache_key_info(key)
+        if info['ttl'] is not None:
+            expires = now + info['ttl']
+        elif info['size'] is None:
+            # The backend does not report it, the object can be as old as the default timeout.
+            expires = now + keyedcache.CACHE_TIMEOUT
+        else:
+            expires = NO_TIMEOUT
+        entries.append((expires, key.encode('utf-8'), pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)))
+
+    offset = HEADER.size + ENTRY.size * len(entries)
+    index = []
+    for expires, key, value in entries:
+        index.append(ENTRY.pack(expires, offset, len(key), offset + len(key), len(value)))
+        offset += len(key) + len(value)
+
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(entries)))
+        f.writelines(index)
+        for expires, key, value in entries:
+            f.write(key)
+            f.write(value)
+    os.replace(tmp, path)
+    log.debug('keyedcache snapshot of %d keys written to %s', len(entries), path)
+    return len(entries)
+
+
+def dump_at_exit(path):
+    """Dumps the registry at exit of a worker which has used the cache.
+
+    Short processes, e.g. management commands, do not overwrite the snapshot.
+    """
+    if keyedcache.CACHE_CALLS and keyedcache.CACHED_KEYS:
+        try:
+            dump(path)
+        except Exception as e:
+            log.warning("Could not write keyedcache snapshot %s: %s", path, e)
+
+
+def read_index(path):
+    """Yields (key, expires, mmap, value offset, value length) of live entries."""
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("%s is not a keyedcache snapshot" % path)
+    now = time.time()
+    for i in range(count):
+        expires, key_offset, key_len, value_offset, value_len = ENTRY.unpack_from(
+            data, HEADER.size + i * ENTRY.size)
+        if expires != NO_TIMEOUT and expires <= now:
+            continue
+        key = data[key_offset:key_offset + key_len].decode('utf-8')
+        yield key, expires, data, value_offset, value_len
+
+
+def _remaining(expires):
+    return None if expires == NO_TIMEOUT else expires - time.time()
+
+
+def _is_local_backend(backend):
+    return backend.__module__.split('.')[-1] == 'locmem' or isinstance(backend, LocalObjectCache)
+
+
+def restore(path, lazy=True, replace=False, local_only=False):
+    """Restores the live entries of the snapshot at ``path``.
+
+    With ``lazy`` the entries of process-local backends are only indexed and
+    loaded by ``cache_get``. Other entries are written now by ``add``, or by
+    ``set`` if ``replace`` is True, unless ``local_only`` is True. Returns the
+    number of restored keys.
+    """
+    global pending
+    restored = 0
+    for key, expires, data, offset, length in read_index(path):
+        backend = keyedcache.cache_backend(key)[1]
+        local = _is_local_backend(backend)
+        if local_only and not local:
+            continue
+        if lazy and local:
+            if pending is None:
+                pending = {}
+            pending[key] = (expires, data, offset, length)
+        else:
+            obj = pickle.loads(data[offset:offset + length])
+            version = keyedcache._version(backend)
+            if replace:
+                backend.set(key, obj, _remaining(expires), version=version)
+            elif not backend.add(key, obj, _remaining(expires), version=version):
+                continue
+        keyedcache.CACHED_KEYS[key] = True
+        restored += 1
+    log.debug('keyedcache snapshot of %d keys restored from %s', restored, path)
+    return restored
+
+
+def load_pending(key):
+    """Moves a lazily restored object into its backend and returns it (or None)."""
+    entries = pending  # discard() can set it to None meanwhile
+    if entries is None:
+        return None
+    try:
+        expires, data, offset, length = entries.pop(key)
+    except KeyError:
+        return None
+    remaining = _remaining(expires)
+    if remaining is not None and remaining <= 0:
+        return None
+    obj = pickle.loads(data[offset:offset + length])
+    backend = keyedcache.cache_backend(key)[1]
+    backend.add(key, obj, remaining, version=keyedcache._version(backend))
+    return obj
+
+
+def discard(keys=None):
+    """Forgets lazily restored entries of ``keys`` (default: all), after a delete."""
+    global pending
+    if pending is None:
+        return
+    if keys is None:
+        pending = None
+    else:
+        for key in keys:
+            pending.pop(key, None)
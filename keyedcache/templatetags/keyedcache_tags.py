@@ -0,0 +1,119 @@
+"""Fragment caching with keyedcache keys.
+
+Usage::
+
+    {% load keyedcache_tags %}
+
+    {% keyedcache 600 product "row" %}
+        ... expensive fragment ...
+    {% endkeyedcache %}
+
+The arguments after the timeout are parts of the key. If the first one has a
+method ``cache_key`` (e.g. ``keyedcache.models.CachedObjectMixin``), the
+fragment is stored as its child ``product.cache_key('fragment', "row")`` and
+``product.cache_delete()`` drops it too. The timeout can be ``None``.
+
+Fragments inside a ``keyedcache_prefetch`` block are fetched by one
+``get_many``::
+
+    {% keyedcache_prefetch %}
+        {% for product in products %}
+            {% keyedcache 600 product "row" %}...{% endkeyedcache %}
+        {% endfor %}
+    {% endkeyedcache_prefetch %}
+
+The block is rendered twice: first without the bodies of the fragments, in
+order to collect their keys, then with the fetched fragments. Fragments
+which were not fetched are rendered without another lookup.
+"""
+import keyedcache
+from django import template
+from django.utils.safestring import mark_safe
+
+register = template.Library()
+
+PREFETCH = '_keyedcache_prefetch'
+
+
+class KeyedCacheNode(template.Node):
+    def __init__(self, nodelist, timeout, parts):
+        self.nodelist = nodelist
+        self.timeout = timeout
+        self.parts = parts
+
+    def fragment_key(self, context):
+        parts = [part.resolve(context) for part in self.parts]
+        if parts and hasattr(parts[0], 'cache_key'):
+            return parts[0].cache_key('fragment', *parts[1:])
+        return keyedcache.cache_key(parts)
+
+    def render(self, context):
+        key = self.fragment_key(context)
+        prefetch = context.get(PREFETCH)
+        if prefetch is not None and prefetch['collecting']:
+            prefetch['keys'].append(key)
+            return ''
+        if prefetch is not None and key in prefetch['fetched']:
+            # a key missing from the fetched values is a miss
+            if key in prefetch['values']:
+                return mark_safe(prefetch['values'][key])
+        else:
+            try:
+                return mark_safe(keyedcache.cache_get(key))
+            except (keyedcache.NotCachedError, keyedcache.MethodNotFinishedError):
+                pass
+
+        value = self.nodelist.render(context)
+        timeout = self.timeout.resolve(context)
+        if timeout is None:
+            keyedcache.cache_set(key, value=value)
+        else:
+            try:
+                keyedcache.cache_set(key, value=value, length=int(timeout))
+            except (ValueError, TypeError):
+                raise template.TemplateSyntaxError('"keyedcache" tag got a non-integer timeout value: %r' % timeout)
+        return value
+
+
+class PrefetchNode(template.Node):
+    def __init__(self, nodelist):
+        self.nodelist = nodelist
+
+    def render(self, context):
+        if context.get(PREFETCH) is not None:
+            # nested, prefetched by the outer block
+            return self.nodelist.render(context)
+
+        prefetch = {'collecting': True, 'keys': [], 'fetched': frozenset(), 'values': {}}
+        with context.push(**{PREFETCH: prefetch}):
+            # state of tags like {% cycle %} must not carry over to the real pass
+            with context.render_context.push():
+                self.nodelist.render(context)
+            prefetch['collecting'] = False
+            if prefetch['keys']:
+                prefetch['values'] = keyedcache.cache_get_many(prefetch['keys'])
+                prefetch['fetched'] = frozenset(prefetch['keys'])
+            return self.nodelist.render(context)
+
+
+@register.tag('keyedcache')
+def do_keyedcache(parser, token):
+    """{% keyedcache timeout key_part [key_part ...] %} ... {% endkeyedcache %}"""
+    nodelist = parser.parse(('endkeyedcache',))
+    parser.delete_first_token()
+    tokens = token.split_contents()
+    if len(tokens) < 3:
+        raise template.TemplateSyntaxError("'%r' tag requires at least 2 arguments." % tokens[0])
+    return KeyedCacheNode(
+        nodelist,
+        parser.compile_filter(tokens[1]),
+        [parser.compile_filter(part) for part in tokens[2:]],
+    )
+
+
+@register.tag('keyedcache_prefetch')
+def do_keyedcache_prefetch(parser, token):
+    """{% keyedcache_prefetch %} ... {% endkeyedcache_prefetch %}"""
+    nodelist = parser.parse(('endkeyedcache_prefetch',))
+    parser.delete_first_token()
+    return PrefetchNode(nodelist)
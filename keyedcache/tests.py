@@ -1,12 +1,22 @@
+import io
+import json
+import os
 import random
+import threading
 import time
+from unittest import mock
 
 import keyedcache
 from django.contrib.auth.models import User
+from django.http import HttpResponse
 from django.urls import reverse
 from django.test import TestCase
 from django.test.utils import override_settings
-from keyedcache.views import stats_page, view_page, delete_page
+from keyedcache import accounting, hotkeys, metrics, shared, snapshot, timing
+from keyedcache.backends import LocalObjectCache
+from keyedcache.decorators import keyedcache_page
+from keyedcache.models import CachedObjectMixin
+from keyedcache.views import stats_page, view_page, delete_page, metrics_page, hotkeys_page
 
 CACHE_HIT = 0
 
@@ -48,6 +58,110 @@ class DecoratorTest(TestCase):
         self.assertNotEqual(orig, keyedcache)
 
 
+class CanonicalArgumentsTest(TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def testSignatureBinding(self):
+        def area(width, height=2, **options):
+            self.calls.append((width, height))
+            return width * height
+
+        area = keyedcache.cache_function(60)(area)
+        self.assertEqual(area(3), 6)
+        self.assertEqual(area(3, 2), 6)
+        self.assertEqual(area(width=3, height=2), 6)
+        self.assertEqual(len(self.calls), 1)
+        area(3, scale=1, unit='m')
+        area(3, unit='m', scale=1)
+        self.assertEqual(len(self.calls), 2)
+
+    def testIgnoreAndQualname(self):
+        test = self
+
+        class Shop(object):
+            def price(self, request, product):
+                test.calls.append(product)
+                return product
+
+        class Other(object):
+            def price(self, request, product):
+                return 'other'
+
+        Shop.price = keyedcache.cache_function(60, ignore=['self', 'request'])(Shop.price)
+        Other.price = keyedcache.cache_function(60, ignore=['self', 'request'])(Other.price)
+        self.assertEqual(Shop().price('request 1', 5), 5)
+        self.assertEqual(Shop().price('request 2', 5), 5)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(Other().price(None, 5), 'other')
+
+        keyedcache.cache_delete_function(Shop.price)
+        Shop().price(None, 5)
+        self.assertEqual(len(self.calls), 2)
+
+    def testLocal(self):
+        def double(x):
+            self.calls.append(x)
+            return 2 * x
+
+        double = keyedcache.cache_function(60, local=True, maxsize=2)(double)
+        self.assertEqual([double(1), double(1), double(2)], [2, 2, 4])
+        self.assertEqual(self.calls, [1, 2])
+        double(3)  # evicts 1
+        double(1)
+        self.assertEqual(self.calls, [1, 2, 3, 1])
+        self.assertEqual([x for x in keyedcache.CACHED_KEYS if 'double' in x], [])
+        keyedcache.cache_delete_function(double)
+        double(1)
+        self.assertEqual(len(self.calls), 5)
+
+
+class AdmissionTest(TestCase):
+    def testCheapLargeResultRejected(self):
+        def big(n):
+            return 'x' * n
+
+        cached = keyedcache.cache_function(60, max_bytes_per_ms=10)(big)
+        self.assertEqual(cached(100000), 'x' * 100000)
+        key = keyedcache.cache_key('func', keyedcache._func_name(big), big.__module__, (('n', 100000),))
+        # neither the result nor the placeholder is left in the cache
+        self.assertRaises(keyedcache.NotCachedError, keyedcache.cache_get, key)
+        stats = keyedcache.FUNCTION_STATS['%s.%s' % (big.__module__, keyedcache._func_name(big))]
+        self.assertEqual((stats['computed'], stats['admitted'], stats['rejected']), (1, 0, 1))
+        self.assertTrue(stats['bytes'] > 100000)
+
+    def testMinCompute(self):
+        def slow(n):
+            time.sleep(0.01)
+            return n
+
+        def fast(n):
+            return n
+
+        slow = keyedcache.cache_function(60, min_compute=0.005)(slow)
+        fast = keyedcache.cache_function(60, min_compute=0.005)(fast)
+        for i in range(2):
+            slow(1)
+            fast(1)
+        stats = dict((name.split('.')[-1], value) for name, value in keyedcache.FUNCTION_STATS.items())
+        self.assertEqual((stats['slow']['hits'], stats['slow']['admitted']), (1, 1))
+        self.assertEqual((stats['fast']['hits'], stats['fast']['rejected'], stats['fast']['bypassed']), (0, 1, 1))
+
+    def testRejectedSkipsBackend(self):
+        def cheap(n):
+            return n
+
+        cheap = keyedcache.cache_function(60, min_compute=1)(cheap)
+        cheap(1)
+        with mock.patch('keyedcache._backend_get') as get, mock.patch('keyedcache._backend_set') as set_, \
+                mock.patch('keyedcache._backend_delete') as delete:
+            for i in range(10):
+                self.assertEqual(cheap(1), 1)
+        self.assertEqual((get.call_count, set_.call_count, delete.call_count), (0, 0, 0))
+        keyedcache.cache_delete_function(cheap)
+        self.assertEqual(cheap.rejected.data, {})
+
+
 class CachingTest(TestCase):
     def testCacheGetFail(self):
         try:
@@ -152,6 +266,780 @@ class TestKeyMaker(TestCase):
         self.assertEqual(v, 'test::3::more::yes')
 
 
+class TimingTest(TestCase):
+    def setUp(self):
+        timing.reset()
+
+    def tearDown(self):
+        keyedcache.keyedcache_configure()
+        timing.reset()
+
+    def testHistogramPercentiles(self):
+        hist = timing.LatencyHistogram()
+        for x in range(1, 101):
+            hist.record(x / 1000.0)
+        self.assertEqual(hist.count, 100)
+        # bucket upper bounds overestimate by less than 25%
+        self.assertTrue(0.050 <= hist.percentile(50) < 0.050 * 1.25)
+        self.assertTrue(0.099 <= hist.percentile(99) <= 0.100)
+        self.assertEqual(timing.LatencyHistogram().percentile(99), 0.0)
+
+    @override_settings(KEYEDCACHE_TIMING=True)
+    def testRecordedPerPrefix(self):
+        keyedcache.keyedcache_configure()
+        keyedcache.cache_set('timed', 1, value=1)
+        keyedcache.cache_get('timed', 1)
+        keyedcache.cache_delete('timed', 1)
+        self.assertEqual(timing.HISTOGRAMS[('get', 'timed')].count, 1)
+        self.assertEqual(timing.HISTOGRAMS[('set', 'timed')].count, 1)
+        self.assertEqual(timing.HISTOGRAMS[('delete', 'timed')].count, 1)
+
+    def testDisabled(self):
+        keyedcache.cache_set('untimed', value=1)
+        keyedcache.cache_get('untimed')
+        self.assertEqual(timing.HISTOGRAMS, {})
+
+
+class MetricsTest(TestCase):
+    def tearDown(self):
+        keyedcache.keyedcache_configure()
+        timing.reset()
+
+    def testRender(self):
+        hist = timing.LatencyHistogram()
+        hist.record(0.003)
+        timing.HISTOGRAMS[('get', 'pre"fix')] = hist
+        text = metrics.render(metrics.snapshot())
+        self.assertTrue(text.endswith('# EOF\n'))
+        self.assertTrue('keyedcache_calls_total %d' % keyedcache.CACHE_CALLS in text)
+        self.assertTrue('keyedcache_tier_hit_ratio{tier="backend"}' in text)
+        self.assertTrue('keyedcache_backend_latency_seconds_bucket{op="get",prefix="pre\\"fix",le="+Inf"} 1'
+                        in text)
+
+    def testMerge(self):
+        snap = metrics.snapshot()
+        total = metrics.merge(metrics.merge({}, snap), snap)
+        self.assertEqual(total['workers'], 2)
+        self.assertEqual(total['calls'], 2 * snap['calls'])
+
+    @override_settings(KEYEDCACHE_METRICS_INTERVAL=60)
+    def testCollectFromBackend(self):
+        keyedcache.keyedcache_configure()
+        # a snapshot published by another worker on this host
+        other = metrics.snapshot()
+        other['calls'] = 1000
+        keyedcache.cache.set(metrics._snapshot_key('other'), other, 60)
+        keyedcache.cache.set(metrics._index_key(), {'other': time.time() + 60}, 60)
+        total = metrics.collect()
+        self.assertEqual(total['workers'], 2)
+        self.assertEqual(total['calls'], 1000 + keyedcache.CACHE_CALLS)
+
+
+class HotKeysTest(TestCase):
+    def tearDown(self):
+        keyedcache.keyedcache_configure()
+
+    def testSpaceSaving(self):
+        sketch = hotkeys.SpaceSaving(3)
+        for x in range(100):
+            sketch.add('hot')
+            sketch.add('cold%d' % x)
+        top = sketch.top(1)
+        self.assertEqual(top[0][0], 'hot')
+        self.assertEqual(top[0][1][0], 100)
+        self.assertEqual(len(sketch.counters), 3)
+
+    @override_settings(KEYEDCACHE_HOTKEY_SAMPLE=1.0)
+    def testSampledFromCacheGet(self):
+        keyedcache.keyedcache_configure()
+        keyedcache.cache_set('hot', value=1)
+        for x in range(20):
+            keyedcache.cache_get('hot')
+        keyedcache.cache_get('cold', default=None)
+        top = keyedcache.cache_hot_keys(1)
+        self.assertEqual(top[0]['key'], 'hot')
+        self.assertEqual(top[0]['count'], 20)
+        self.assertTrue(top[0]['rate'] > 0)
+
+
+class ReplicationTest(TestCase):
+    def tearDown(self):
+        keyedcache.keyedcache_configure()
+
+    @override_settings(KEYEDCACHE_REPLICAS=3, KEYEDCACHE_REPLICATED_KEYS=['config'])
+    def testConfiguredReplicas(self):
+        keyedcache.keyedcache_configure()
+        self.assertEqual(keyedcache.cache_replica_keys('other'), ['other'])
+        replicas = keyedcache.cache_replica_keys(keyedcache.cache_key('config', 'site'))
+        self.assertEqual(replicas, ['config::site', 'config::site@r1', 'config::site@r2'])
+
+        keyedcache.cache_set('config', 'site', value='x', length=30)
+        for replica in replicas:
+            self.assertEqual(keyedcache.cache.get(replica).val, 'x')
+        for x in range(10):
+            self.assertEqual(keyedcache.cache_get('config', 'site'), 'x')
+
+        keyedcache.cache_delete('config', children=True)
+        for replica in replicas:
+            self.assertEqual(keyedcache.cache.get(replica), None)
+        self.assertEqual(keyedcache.cache_get('config', 'site', default=None), None)
+
+    @override_settings(KEYEDCACHE_REPLICAS=3, KEYEDCACHE_REPLICATED_KEYS=['config'], KEYEDCACHE_REPLICA_TIMEOUT=1)
+    def testExpiredReplicasRefilled(self):
+        keyedcache.keyedcache_configure()
+        keyedcache.cache_set('config', 'site', value='x', length=60)
+        time.sleep(1.2)
+        replicas = keyedcache.cache_replica_keys('config::site')
+        self.assertEqual([keyedcache.cache.get(replica) for replica in replicas[1:]], [None, None])
+        for x in range(30):
+            self.assertEqual(keyedcache.cache_get('config', 'site'), 'x')
+        for replica in replicas:
+            self.assertEqual(keyedcache.cache.get(replica).val, 'x')
+
+        with mock.patch.object(keyedcache.cache, 'get', wraps=keyedcache.cache.get) as get:
+            for x in range(30):
+                keyedcache.cache_get('config', 'site')
+        self.assertEqual(get.call_count, 30)
+        keyedcache.cache_delete('config', children=True)
+
+    @override_settings(KEYEDCACHE_REPLICAS=2, KEYEDCACHE_REPLICATE_HOT=0.001, KEYEDCACHE_HOTKEY_SAMPLE=1.0)
+    def testHotReplicas(self):
+        keyedcache.keyedcache_configure()
+        keyedcache.cache_set('trending', value=1)
+        for x in range(5):
+            keyedcache.cache_get('trending')
+        keyedcache._hot_refresh = 0  # the set of hot keys is refreshed every 10 seconds
+        self.assertEqual(keyedcache.cache_replica_keys('trending'), ['trending', 'trending@r1'])
+        keyedcache.cache_set('trending', value=2)
+        self.assertEqual(keyedcache.cache.get('trending@r1').val, 2)
+
+        # no longer hot here, but maybe in another process
+        keyedcache._hot_replicated = frozenset()
+        keyedcache._hot_refresh = time.time() + 10
+        keyedcache.cache_set('trending', value=3)
+        self.assertEqual(keyedcache.cache.get('trending@r1'), None)
+        keyedcache._hot_replicated = frozenset(['trending'])
+        self.assertEqual(set(keyedcache.cache_get('trending') for x in range(20)), set([3]))
+
+
+ROUTED = override_settings(
+    CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'TIMEOUT': 300},
+        'config': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'config'},
+    },
+    KEYEDCACHE_ROUTES={'config': 'config', 'config::big': 'default'})
+
+
+class RoutingTest(TestCase):
+    def tearDown(self):
+        keyedcache.cache.delete(keyedcache.EPOCH_KEY)
+        keyedcache.keyedcache_configure()
+
+    @ROUTED
+    def testRoutes(self):
+        from django.core.cache import caches
+        keyedcache.keyedcache_configure()
+        self.assertEqual(keyedcache.cache_backend('config')[0], 'config')
+        self.assertEqual(keyedcache.cache_backend('config::site')[0], 'config')
+        self.assertEqual(keyedcache.cache_backend('config::big::x')[0], 'default')
+        self.assertEqual(keyedcache.cache_backend('configuration')[0], 'default')
+
+        keyedcache.cache_set('config', 'site', value='x')
+        self.assertEqual(caches['config'].get('config::site').val, 'x')
+        self.assertEqual(caches['default'].get('config::site'), None)
+        self.assertEqual(keyedcache.cache_get('config', 'site'), 'x')
+        self.assertEqual(keyedcache.ALIAS_STATS['config']['hits'], 1)
+
+        keyedcache.cache_delete('config', children=True)
+        self.assertEqual(caches['config'].get('config::site'), None)
+
+    @ROUTED
+    def testFlushAll(self):
+        keyedcache.keyedcache_configure()
+        keyedcache.cache_set('config', 'a', value=1)
+        keyedcache.cache_set('other', value=2)
+        keyedcache.cache_delete()
+        self.assertEqual(keyedcache.cache_get('config', 'a', default=None), None)
+        self.assertEqual(keyedcache.cache_get('other', default=None), None)
+
+    def testUnknownAlias(self):
+        from django.core.exceptions import ImproperlyConfigured
+        with self.settings(KEYEDCACHE_ROUTES={'x': 'missing'}):
+            self.assertRaises(ImproperlyConfigured, keyedcache.keyedcache_configure)
+
+
+class BulkDeleteTest(TestCase):
+    def tearDown(self):
+        keyedcache.cache.delete(keyedcache.EPOCH_KEY)
+        keyedcache.keyedcache_configure()
+
+    @override_settings(KEYEDCACHE_DELETE_CHUNK=3)
+    def testChunkedChildren(self):
+        keyedcache.keyedcache_configure()
+        for x in range(7):
+            keyedcache.cache_set('bulk', x, value=x)
+        with mock.patch.object(keyedcache.cache, 'delete_many', wraps=keyedcache.cache.delete_many) as delete_many:
+            removed = keyedcache.cache_delete('bulk', children=True)
+        self.assertEqual(len(removed), 7)
+        self.assertEqual([len(call[0][0]) for call in delete_many.call_args_list], [3, 3, 2])
+        self.assertEqual(keyedcache.cache_get('bulk', 0, default=None), None)
+
+        progress = []
+        keyedcache.cache_set('bulk', 'a', value=1)
+        keyedcache.cache_set('bulk', 'b', value=2)
+        keyedcache.cache_delete_many(['bulk::a', 'bulk::b'], progress=lambda *args: progress.append(args))
+        self.assertEqual(progress, [(2, 2)])
+
+    def testEpoch(self):
+        keyedcache.cache_set('epoch', 'old', value='old')
+        self.assertEqual(keyedcache.cache_epoch(), 0)
+        keyedcache.cache_delete()
+        epoch = keyedcache.cache_epoch()
+        self.assertTrue(epoch >= time.time() - 10)
+        self.assertEqual(keyedcache.cache_get('epoch', 'old', default=None), None)
+        # the old object is only unreachable
+        self.assertEqual(keyedcache.cache.get('epoch::old').val, 'old')
+
+        keyedcache.cache_set('epoch', 'new', value='new', length=60)
+        self.assertEqual(keyedcache.cache_get('epoch', 'new'), 'new')
+        self.assertTrue(0 < keyedcache.cache_key_info('epoch::new')['ttl'] <= 60)
+        self.assertEqual(keyedcache.cache.get('epoch::new'), None)
+
+        # other processes see the new epoch after the refresh
+        keyedcache.cache.set(keyedcache.EPOCH_KEY, epoch + 1, None)
+        self.assertEqual(keyedcache.cache_epoch(), epoch)
+        keyedcache._epoch_refresh = 0
+        self.assertEqual(keyedcache.cache_epoch(), epoch + 1)
+        self.assertEqual(keyedcache.cache_get('epoch', 'new', default=None), None)
+
+        # an evicted epoch is created again, the objects of epoch 0 stay unreachable
+        keyedcache.cache.delete(keyedcache.EPOCH_KEY)
+        self.assertEqual(keyedcache.cache_epoch(refresh=True), epoch + 2)
+        self.assertEqual(keyedcache.cache.get(keyedcache.EPOCH_KEY), epoch + 2)
+        self.assertEqual(keyedcache.cache_get('epoch', 'old', default=None), None)
+
+
+class TagTest(TestCase):
+    def testInvalidateTag(self):
+        keyedcache.cache_set_tagged(['product:1'], 'page', 'product', 1, value='page')
+        keyedcache.cache_set_tagged(['product:1', 'category:2'], 'listing', 2, value='listing')
+        keyedcache.cache_set_tagged('category:2', 'search', 'shoes', value='results')
+        self.assertEqual(keyedcache.cache_get('page', 'product', 1), 'page')
+
+        keyedcache.cache_invalidate_tag('product:1')
+        self.assertEqual(keyedcache.cache_get('page', 'product', 1, default=None), None)
+        self.assertEqual(keyedcache.cache_get('listing', 2, default=None), None)
+        self.assertEqual(keyedcache.cache_get('search', 'shoes'), 'results')
+
+        keyedcache.cache_set_tagged(['product:1'], 'page', 'product', 1, value='new page')
+        self.assertEqual(keyedcache.cache_get('page', 'product', 1), 'new page')
+
+    def testEvictedTagVersion(self):
+        keyedcache.cache_set_tagged(['evicted'], 'tagged', value=1)
+        keyedcache.cache.delete(keyedcache.cache_key('keyedcache', 'tag', 'evicted'))
+        self.assertEqual(keyedcache.cache_get('tagged', default=None), None)
+
+    def testCachedFunctionTags(self):
+        calls = []
+
+        def price(product_id):
+            calls.append(product_id)
+            return product_id * 10
+
+        price = keyedcache.cache_function(60, tags=lambda product_id: ['product:%d' % product_id])(price)
+        self.assertEqual(price(7), 70)
+        self.assertEqual(price(7), 70)
+        self.assertEqual(len(calls), 1)
+        keyedcache.cache_invalidate_tag('product:7')
+        self.assertEqual(price(7), 70)
+        self.assertEqual(len(calls), 2)
+
+
+class DeferredTest(TestCase):
+    def testCoalescedWrites(self):
+        keyedcache.cache_set('deferred', 'old', value=1)
+        with keyedcache.cache_deferred():
+            for x in range(5):
+                keyedcache.cache_set('deferred', 'a', value=x)
+            keyedcache.cache_set('deferred', 'b', value='b', length=10)
+            keyedcache.cache_delete('deferred', 'old')
+            # not written yet, but visible in this thread
+            self.assertEqual(keyedcache.cache.get('deferred::a'), None)
+            self.assertEqual(keyedcache.cache_get('deferred', 'a'), 4)
+            self.assertEqual(keyedcache.cache_get('deferred', 'old', default=None), None)
+            self.assertTrue(keyedcache.cache.get('deferred::old') is not None)
+
+        self.assertEqual(keyedcache.cache.get('deferred::a').val, 4)
+        self.assertEqual(keyedcache.cache_get('deferred', 'b'), 'b')
+        self.assertEqual(keyedcache.cache.get('deferred::old'), None)
+
+    def testDeleteChildren(self):
+        with keyedcache.cache_deferred():
+            keyedcache.cache_set('deferred', 'tree', 1, value=1)
+            keyedcache.cache_delete('deferred', 'tree', children=True)
+            keyedcache.cache_set('deferred', 'tree', 2, value=2)
+        self.assertEqual(keyedcache.cache_get('deferred', 'tree', 1, default=None), None)
+        self.assertEqual(keyedcache.cache_get('deferred', 'tree', 2), 2)
+
+    def testMiddleware(self):
+        from keyedcache.middleware import DeferredWritesMiddleware
+
+        def view(request):
+            keyedcache.cache_set('deferred', 'view', value='v')
+            self.assertEqual(keyedcache.cache.get('deferred::view'), None)
+            return 'response'
+
+        self.assertEqual(DeferredWritesMiddleware(view)(None), 'response')
+        self.assertEqual(keyedcache.cache.get('deferred::view').val, 'v')
+
+
+class GetOrComputeTest(TestCase):
+    def testCachesResult(self):
+        calls = []
+        loader = lambda: calls.append(1) or 'computed'
+        self.assertEqual(keyedcache.cache_get_or_compute(('compute', 1), loader), 'computed')
+        self.assertEqual(keyedcache.cache_get_or_compute(('compute', 1), loader), 'computed')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(keyedcache.cache_get('compute', 1), 'computed')
+
+    def testConcurrentCallersShareLoad(self):
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def loader():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'shared'
+
+        def worker():
+            results.append(keyedcache.cache_get_or_compute('coalesced', loader))
+
+        threads = [threading.Thread(target=worker) for x in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['shared'] * 5)
+
+    def testLeaderChecksAgain(self):
+        loader = mock.Mock(return_value='computed')
+        with mock.patch('keyedcache.cache_get', side_effect=[keyedcache.NotCachedError('late'), 'loaded']):
+            self.assertEqual(keyedcache.cache_get_or_compute('late', loader), 'loaded')
+        self.assertEqual(loader.call_count, 0)
+
+    def testLoaderErrorNotCached(self):
+        def loader():
+            raise KeyError('missing')
+
+        self.assertRaises(KeyError, keyedcache.cache_get_or_compute, 'failing', loader)
+        self.assertEqual(keyedcache.cache_get('failing', default=None), None)
+        self.assertEqual(keyedcache._inflight, {})
+
+    def testFindById(self):
+        from keyedcache.models import find_by_id
+        user = User.objects.create_user('bob', 'bob@example.com', 'secret')
+        self.assertEqual(find_by_id(User, 'user', user.pk), user)
+        User.objects.filter(pk=user.pk).delete()
+        # served from the cache
+        self.assertEqual(find_by_id(User, 'user', user.pk), user)
+        self.assertEqual(find_by_id(User, 'user', 999999), None)
+        self.assertRaises(User.DoesNotExist, find_by_id, User, 'user', 999999, raises=True)
+
+
+OBJECTS = override_settings(
+    CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'TIMEOUT': 300},
+        'objects': {'BACKEND': 'keyedcache.backends.LocalObjectCache', 'LOCATION': 'objects',
+                    'OPTIONS': {'COPY_ON_READ': ['builtins.list']}},
+    },
+    KEYEDCACHE_ALIAS='objects')
+
+
+class LocalObjectCacheTest(TestCase):
+    def tearDown(self):
+        keyedcache.keyedcache_configure()
+
+    def testReferencesAndEviction(self):
+        backend = LocalObjectCache('test-objects', {'OPTIONS': {'MAX_ENTRIES': 4, 'STRIPES': 1}})
+        config = {'a': 1}
+        backend.set('config', config)
+        self.assertTrue(backend.get('config') is config)
+        self.assertFalse(backend.add('config', {}))
+        for i in range(4):
+            backend.set('key%d' % i, i)
+        self.assertEqual(backend.get('config'), None)
+        self.assertEqual(backend.get('key0'), 0)
+
+        backend.set('short', 1, timeout=-1)
+        self.assertFalse(backend.has_key('short'))
+        self.assertEqual(backend.incr('key0', 2), 2)
+        self.assertTrue(backend.delete('key0'))
+        self.assertFalse(backend.delete('key0'))
+
+    @OBJECTS
+    def testKeyedcacheAlias(self):
+        keyedcache.keyedcache_configure()
+        self.assertTrue(isinstance(keyedcache.cache, LocalObjectCache))
+        config = {'a': 1}
+        items = [1, 2]
+        keyedcache.cache_set('objects', 'config', value=config, length=60)
+        keyedcache.cache_set('objects', 'items', value=items)
+        self.assertTrue(keyedcache.cache_get('objects', 'config') is config)
+        # declared mutable types are copied
+        items.append(3)
+        cached = keyedcache.cache_get('objects', 'items')
+        self.assertEqual(cached, [1, 2])
+        cached.append(4)
+        self.assertEqual(keyedcache.cache_get('objects', 'items'), [1, 2])
+
+        info = keyedcache.cache_key_info('objects::config')
+        self.assertTrue(info['size'] > 0 and 0 < info['ttl'] <= 60)
+        keyedcache.cache_delete('objects', children=True)
+        self.assertEqual(keyedcache.cache_get('objects', 'config', default=None), None)
+
+
+class SharedTierTest(TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'keyedcache.shared')
+
+    def tearDown(self):
+        import shutil
+        with override_settings(KEYEDCACHE_SHARED_TIER=None):
+            keyedcache.keyedcache_configure()
+        shutil.rmtree(self.tmpdir)
+
+    def testSharedBetweenMappings(self):
+        first = shared.SharedTier(self.path, slots=16, slot_size=256)
+        second = shared.SharedTier(self.path, slots=16, slot_size=256)
+        self.assertTrue(first.set('shared::a', {'a': 1}))
+        self.assertEqual(second.get('shared::a'), {'a': 1})
+        self.assertFalse(first.set('shared::big', 'x' * 1000))
+        self.assertEqual(second.get('shared::big'), None)
+        self.assertFalse(first.set('shared::lock', threading.Lock()))
+        with mock.patch('keyedcache.shared.pickle.dumps') as dumps:
+            self.assertFalse(first.set('shared::big', 'x' * 1000))
+        self.assertEqual(dumps.call_count, 0)
+
+        # a slot being written is not read
+        offset = first._offset(shared._hash(b'shared::a'))
+        sequence = shared.SEQUENCE.unpack_from(first.map, offset)[0]
+        shared.SEQUENCE.pack_into(first.map, offset, sequence + 1)
+        self.assertEqual(second.get('shared::a'), None)
+        shared.SEQUENCE.pack_into(first.map, offset, sequence)
+
+        # a copy read before a concurrent write or delete is not stored
+        sequence = first.sequence('shared::a')
+        second.delete('shared::a')
+        self.assertFalse(first.set('shared::a', {'a': 0}, sequence))
+        self.assertEqual(first.get('shared::a'), None)
+        # also when the key was not there
+        sequence = first.sequence('shared::a')
+        second.delete('shared::a')
+        self.assertFalse(first.set('shared::a', {'a': 0}, sequence))
+        self.assertTrue(first.set('shared::a', {'a': 2}, first.sequence('shared::a')))
+        self.assertEqual(second.get('shared::a'), {'a': 2})
+
+        second.delete('shared::a')
+        self.assertEqual(first.get('shared::a'), None)
+        first.close()
+        second.close()
+
+    def testTier(self):
+        with override_settings(KEYEDCACHE_SHARED_TIER=self.path, KEYEDCACHE_SHARED_SLOTS=64):
+            keyedcache.keyedcache_configure()
+        keyedcache.cache_set('shared', 1, value='one')
+        self.assertEqual(keyedcache.cache_get('shared', 1), 'one')
+        # another worker of this host would find it without the backend
+        keyedcache.cache.delete('shared::1')
+        hits = keyedcache.TIER_HITS['shared']
+        self.assertEqual(keyedcache.cache_get('shared', 1), 'one')
+        self.assertEqual(keyedcache.TIER_HITS['shared'], hits + 1)
+
+        keyedcache.cache_set('shared', 1, value='new')
+        self.assertEqual(keyedcache.cache_get('shared', 1), 'new')
+        keyedcache.cache_delete('shared', 1)
+        self.assertEqual(keyedcache.cache_get('shared', 1, default=None), None)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'keyedcache.backends.LocalObjectCache',
+                                           'LOCATION': 'shared-objects'}})
+    def testUnpicklable(self):
+        with override_settings(KEYEDCACHE_SHARED_TIER=self.path, KEYEDCACHE_SHARED_SLOTS=64):
+            keyedcache.keyedcache_configure()
+        lock = threading.Lock()
+        keyedcache.cache_set('shared', 'lock', value=lock)
+        self.assertIs(keyedcache.cache_get('shared', 'lock'), lock)
+
+
+class SnapshotTest(TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'keyedcache.snapshot')
+
+    def tearDown(self):
+        import shutil
+        snapshot.discard()
+        shutil.rmtree(self.tmpdir)
+
+    def testLazyRestore(self):
+        keyedcache.cache_set('snap', 1, value={'a': 1}, length=60)
+        keyedcache.cache_set('snap', 2, value='two', length=60)
+        self.assertEqual(snapshot.dump(self.path, ['snap::1', 'snap::2', 'snap::missing']), 2)
+
+        keyedcache.cache.delete('snap::1')
+        keyedcache.cache.delete('snap::2')
+        self.assertEqual(snapshot.restore(self.path, lazy=True), 2)
+        self.assertEqual(keyedcache.cache.get('snap::1'), None)
+        self.assertEqual(keyedcache.cache_get('snap', 1), {'a': 1})
+        self.assertEqual(keyedcache.cache.get('snap::1').val, {'a': 1})
+        self.assertTrue(0 < keyedcache.cache_key_info('snap::1')['ttl'] <= 60)
+
+        # deleted keys are not restored later
+        keyedcache.cache_delete('snap', 2)
+        self.assertEqual(keyedcache.cache_get('snap', 2, default=None), None)
+
+    def testOverwrittenNotRestored(self):
+        keyedcache.cache_set('snap', 'over', value='old', length=60)
+        keyedcache.cache_set('snap', 'deferred', value='old', length=60)
+        snapshot.dump(self.path, ['snap::over', 'snap::deferred'])
+        keyedcache.cache.delete('snap::over')
+        keyedcache.cache.delete('snap::deferred')
+        self.assertEqual(snapshot.restore(self.path, lazy=True), 2)
+
+        keyedcache.cache_set('snap', 'over', value='new', length=1)
+        with keyedcache.cache_deferred():
+            keyedcache.cache_set('snap', 'deferred', value='new', length=1)
+        time.sleep(1.2)
+        self.assertEqual(keyedcache.cache_get('snap', 'over', default=None), None)
+        self.assertEqual(keyedcache.cache_get('snap', 'deferred', default=None), None)
+
+    def testLoadAfterDiscard(self):
+        self.assertEqual(snapshot.pending, None)
+        self.assertEqual(snapshot.load_pending('snap::gone'), None)
+
+    def testExpiredSkippedWithoutUnpickling(self):
+        key = b'snap::expired'
+        with open(self.path, 'wb') as f:
+            f.write(snapshot.HEADER.pack(snapshot.MAGIC, 1))
+            offset = snapshot.HEADER.size + snapshot.ENTRY.size
+            f.write(snapshot.ENTRY.pack(time.time() - 1, offset, len(key), offset + len(key), 3))
+            f.write(key + b'bad')
+        self.assertEqual(snapshot.restore(self.path, lazy=False), 0)
+
+    def testLocalOnly(self):
+        keyedcache.cache_set('snap', 'shared', value='s', length=60)
+        snapshot.dump(self.path, ['snap::shared'])
+        keyedcache.cache.delete('snap::shared')
+        with mock.patch('keyedcache.snapshot._is_local_backend', return_value=False), \
+                mock.patch.object(keyedcache.cache, 'add') as add:
+            self.assertEqual(snapshot.restore(self.path, lazy=True, local_only=True), 0)
+            self.assertEqual(snapshot.restore(self.path, lazy=True), 1)
+        self.assertEqual(add.call_count, 1)
+        self.assertEqual(snapshot.pending, None)
+
+    def testCommands(self):
+        from django.core.management import call_command
+        keyedcache.cache_set('snap', 'cmd', value='c', length=60)
+        keys_file = os.path.join(self.tmpdir, 'keys.csv')
+        with open(keys_file, 'w') as f:
+            f.write('snap::cmd\n')
+        call_command('keyedcache_snapshot', self.path, keys=keys_file, stdout=io.StringIO())
+        keyedcache.cache.delete('snap::cmd')
+        call_command('keyedcache_restore', self.path, stdout=io.StringIO())
+        self.assertEqual(keyedcache.cache.get('snap::cmd').val, 'c')
+
+
+class FragmentItem(CachedObjectMixin):
+    def __init__(self, pk):
+        self.pk = pk
+
+    def _get_pk_val(self):
+        return self.pk
+
+
+class FragmentTagTest(TestCase):
+    def setUp(self):
+        self.rendered = []
+        self.items = [FragmentItem(x) for x in range(5)]
+
+    def render(self, source):
+        from django.template import Context, Template
+        test = self
+
+        class Counter(object):
+            def __call__(self):
+                test.rendered.append(1)
+                return 'body'
+
+        return Template('{% load keyedcache_tags %}' + source).render(
+            Context({'items': self.items, 'counter': Counter()}))
+
+    def testFragment(self):
+        source = '{% keyedcache 60 "frag" "single" %}{{ counter }}{% endkeyedcache %}'
+        self.assertEqual(self.render(source), 'body')
+        self.assertEqual(self.render(source), 'body')
+        self.assertEqual(len(self.rendered), 1)
+        self.assertEqual(keyedcache.cache_get('frag', 'single'), 'body')
+
+    def testPrefetch(self):
+        source = ('{% keyedcache_prefetch %}{% for item in items %}'
+                  '{% keyedcache None item "row" %}{{ item.pk }}{{ counter }},{% endkeyedcache %}'
+                  '{% endfor %}{% endkeyedcache_prefetch %}')
+        expected = ''.join('%dbody,' % x for x in range(5))
+        with mock.patch('keyedcache._backend_get', wraps=keyedcache._backend_get) as get:
+            self.assertEqual(self.render(source), expected)
+        self.assertEqual(len(self.rendered), 5)
+        self.assertEqual(get.call_count, 0)
+
+        with mock.patch('keyedcache._backend_get', wraps=keyedcache._backend_get) as get, \
+                mock.patch.object(keyedcache.cache, 'get_many', wraps=keyedcache.cache.get_many) as get_many:
+            self.assertEqual(self.render(source), expected)
+        self.assertEqual(len(self.rendered), 5)
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(get.call_count, 0)
+
+        # the collecting pass does not advance {% cycle %}
+        cycled = ('{% keyedcache_prefetch %}{% for item in items %}{% cycle "odd" "even" %},'
+                  '{% endfor %}{% endkeyedcache_prefetch %}')
+        self.assertEqual(self.render(cycled), 'odd,even,odd,even,odd,')
+
+        # the fragments are children of the objects
+        self.items[2].cache_delete()
+        self.assertEqual(self.render(source), expected)
+        self.assertEqual(len(self.rendered), 6)
+
+
+class PageDecoratorTest(TestCase):
+    def setUp(self):
+        from django.test import RequestFactory
+        self.factory = RequestFactory()
+        self.item = FragmentItem(42)
+        self.item.cache_delete()
+        self.calls = []
+
+        def detail(request, pk):
+            self.calls.append(pk)
+            return HttpResponse('product %s' % pk)
+
+        self.view = keyedcache_page(60, prefix=lambda request, pk: self.item)(detail)
+
+    def testWeakEtag(self):
+        from django.middleware.gzip import GZipMiddleware
+
+        def long_detail(request):
+            self.calls.append(1)
+            return HttpResponse('product ' * 100)
+
+        handler = GZipMiddleware(keyedcache_page(60, prefix=lambda request: self.item)(long_detail))
+        response = handler(self.factory.get('/product/', HTTP_ACCEPT_ENCODING='gzip'))
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        for if_none_match in (etag, '"other", %s' % etag, '*'):
+            response = handler(self.factory.get('/product/', HTTP_ACCEPT_ENCODING='gzip',
+                                                HTTP_IF_NONE_MATCH=if_none_match))
+            self.assertEqual(response.status_code, 304)
+        response = handler(self.factory.get('/product/', HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH='"other"'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.calls), 1)
+
+    def testCachedWithEtag(self):
+        response = self.view(self.factory.get('/product/42/'), pk=42)
+        self.assertEqual(response.content, b'product 42')
+        etag = response['ETag']
+        response = self.view(self.factory.get('/product/42/'), pk=42)
+        self.assertEqual(response.content, b'product 42')
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(len(self.calls), 1)
+
+        with mock.patch('keyedcache._backend_get', wraps=keyedcache._backend_get) as get:
+            response = self.view(self.factory.get('/product/42/', HTTP_IF_NONE_MATCH=etag), pk=42)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(get.call_count, 1)  # the ETag only
+        self.assertEqual(len(self.calls), 1)
+
+        # other query, other page
+        self.view(self.factory.get('/product/42/?page=2'), pk=42)
+        self.assertEqual(len(self.calls), 2)
+
+    def testInvalidatedByObject(self):
+        self.view(self.factory.get('/product/42/'), pk=42)
+        self.item.cache_delete()
+        response = self.view(self.factory.get('/product/42/'), pk=42)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.calls), 2)
+
+    def testNotCached(self):
+        def private(request):
+            self.calls.append(1)
+            response = HttpResponse('secret')
+            response['Cache-Control'] = 'private'
+            return response
+
+        view = keyedcache_page(60)(private)
+        view(self.factory.get('/private/'))
+        view(self.factory.get('/private/'))
+        self.view(self.factory.post('/product/42/'), pk=42)
+        self.assertEqual(len(self.calls), 3)
+
+
+    def testResponseVary(self):
+        from django.utils.cache import patch_vary_headers
+
+        def hello(request):
+            self.calls.append(1)
+            response = HttpResponse('hello %s' % request.COOKIES.get('name'))
+            patch_vary_headers(response, ['Cookie'])
+            return response
+
+        view = keyedcache_page(60)(hello)
+        alice = view(self.factory.get('/hello/', HTTP_COOKIE='name=alice'))
+        bob = view(self.factory.get('/hello/', HTTP_COOKIE='name=bob'))
+        self.assertEqual((alice.content, bob.content), (b'hello alice', b'hello bob'))
+        self.assertEqual(len(self.calls), 2)
+
+        # the same Vary selected in the decorator is cached, by the user
+        view = keyedcache_page(60, vary_on_user=True)(hello)
+        request = self.factory.get('/hello/', HTTP_COOKIE='name=alice')
+        request.user = User(pk=1)
+        view(request)
+        view(request)
+        self.assertEqual(len(self.calls), 3)
+
+
+class AccountingTest(TestCase):
+    @override_settings(KEYEDCACHE_ACCOUNTING_BYTES=True, KEYEDCACHE_NPLUS1_THRESHOLD=10)
+    def testServerTiming(self):
+        from django.test import RequestFactory
+        from keyedcache.middleware import RequestAccountingMiddleware
+
+        def view(request):
+            keyedcache.cache_set('acct', 0, value='x' * 100)
+            for x in range(12):
+                keyedcache.cache_get('acct', x, default=None)
+            keyedcache.cache_get_many([keyedcache.cache_key('acct', 0)])
+            return HttpResponse('ok')
+
+        keyedcache.cache_get('acct', 'first', default=None)  # the first call of a process checks the cache
+        response = RequestAccountingMiddleware(view)(RequestFactory().get('/'))
+        header = response['Server-Timing']
+        self.assertTrue('kc-get;dur=' in header)
+        self.assertTrue('kc-set;dur=' in header)
+        self.assertTrue('desc="12 calls"' in header)
+        self.assertTrue('hits=2 misses=11' in header)
+        self.assertTrue('kc-nplus1;desc="acct x12"' in header)
+        self.assertFalse('bytes=0' in header)
+        self.assertEqual(getattr(accounting.local, 'current', None), None)
+
+
 @override_settings(ROOT_URLCONF='keyedcache.tests_urls')
 class TestClient(TestCase):
     def test_basic_views(self):
@@ -165,9 +1053,58 @@ class TestClient(TestCase):
         # User must be in staff
         user.is_staff = True
         user.save()
+        keyedcache.cache_function(60)(lambda: 'stats')()
         response = self.client.get(reverse(stats_page))
         self.assertContains(response, 'Cache Hit Rate')
+        self.assertContains(response, 'Cached Functions')
         response = self.client.get(reverse(view_page))
         self.assertContains(response, 'Cache Keys')
         response = self.client.get(reverse(delete_page))
         self.assertContains(response, 'Key to delete:')
+        keyedcache.cache_set('deleted', 1, value=1)
+        response = self.client.post(reverse(delete_page), {'tag': 'deleted', 'children': 'Y', 'kill_all': 'N'})
+        self.assertContains(response, 'Deleted deleted and children: 1 key in')
+        self.assertEqual(keyedcache.cache_get('deleted', 1, default=None), None)
+        response = self.client.get(reverse(metrics_page))
+        self.assertContains(response, 'keyedcache_calls_total')
+        response = self.client.get(reverse(hotkeys_page))
+        self.assertEqual(response.json()['keys'], [])
+
+    def test_key_browser(self):
+        user = User.objects.create_user('alice', 'alice@example.com', 'secret')
+        user.is_staff = True
+        user.save()
+        self.client.login(username='alice', password='secret')
+        for x in range(5):
+            keyedcache.cache_set('browse', x, value=x)
+            keyedcache.cache_set('browse', x, 'child', value=x)
+        url = reverse(view_page)
+
+        response = self.client.get(url, {'prefix': 'browse::', 'limit': 3})
+        self.assertEqual(response.context['key_count'], 10)
+        keys = [row['key'] for row in response.context['cached_keys']]
+        self.assertEqual(keys, ['browse::0', 'browse::0::child', 'browse::1'])
+        self.assertTrue(response.context['cached_keys'][0]['size'] > 0)
+        self.assertEqual(dict(response.context['groups'])['browse::0'], 2)
+
+        response = self.client.get(url, {'prefix': 'browse::', 'limit': 3, 'after': 'browse::1'})
+        keys = [row['key'] for row in response.context['cached_keys']]
+        self.assertEqual(keys, ['browse::1::child', 'browse::2', 'browse::2::child'])
+
+        response = self.client.get(url, {'prefix': 'browse::', 'format': 'json'})
+        self.assertEqual(len(json.loads(b''.join(response.streaming_content))), 10)
+        response = self.client.get(url, {'prefix': 'browse::4', 'format': 'csv'})
+        self.assertEqual(sorted(b''.join(response.streaming_content).split()), [b'browse::4', b'browse::4::child'])
+
+        response = self.client.post(url + '?prefix=browse::', {'delete': 'browse::3'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(keyedcache.cache_get('browse', 3, 'child', default=None), None)
+        self.assertEqual(keyedcache.cache_get('browse', 2, 'child'), 2)
+
+    def test_metrics_access(self):
+        response = self.client.get(reverse(metrics_page))
+        self.assertEqual(response.status_code, 403)
+        with self.settings(INTERNAL_IPS=['127.0.0.1']):
+            response = self.client.get(reverse(metrics_page))
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response['Content-Type'].startswith('application/openmetrics-text'))
@@ -0,0 +1,98 @@
+"""Latency histograms of the backend calls issued by keyedcache.
+
+To enable, put this to settings.py::
+
+    KEYEDCACHE_TIMING = True
+    KEYEDCACHE_SLOW_CALL = 0.05   # seconds, calls slower than this are logged
+
+Latencies are counted into fixed buckets (like HDR histograms) per operation
+and key prefix, so that recording is O(log buckets) and the memory is bounded
+by the number of distinct prefixes, not by the number of calls.
+"""
+import logging
+from bisect import bisect_left
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the buckets in microseconds: four linear sub-buckets for
+# every power of two from 1 us to about 67 s. The reported percentile is the
+# upper bound of its bucket, so it is never more than 25% too high.
+SUB_BUCKETS = 4
+BUCKETS = sorted(set(
+    (1 << exp) + (1 << exp) * sub // SUB_BUCKETS
+    for exp in range(0, 26)
+    for sub in range(0, SUB_BUCKETS)
+))
+
+SLOW_CALL = 0.1
+
+# (operation, key prefix) => LatencyHistogram
+HISTOGRAMS = {}
+
+
+class LatencyHistogram(object):
+    """Fixed-bucket latency histogram. Values are recorded in seconds."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds * 1e6)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, pct):
+        """Upper bound (in seconds) of the bucket containing the percentile."""
+        if not self.count:
+            return 0.0
+        rank = self.count * pct / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                if i >= len(BUCKETS):
+                    return self.max
+                return min(BUCKETS[i] / 1e6, self.max)
+        return self.max
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+
+def record(op, prefix, key, seconds):
+    try:
+        hist = HISTOGRAMS[(op, prefix)]
+    except KeyError:
+        hist = HISTOGRAMS[(op, prefix)] = LatencyHistogram()
+    hist.record(seconds)
+    if seconds >= SLOW_CALL:
+        log.warning('slow cache %s (%.1f ms): %s', op, seconds * 1000, key)
+
+
+def reset():
+    HISTOGRAMS.clear()
+
+
+def summary():
+    """Percentiles for every (operation, prefix) pair, in milliseconds."""
+    rows = []
+    for (op, prefix), hist in sorted(HISTOGRAMS.items()):
+        rows.append({
+            'op': op,
+            'prefix': prefix,
+            'count': hist.count,
+            'p50': "%.2f" % (hist.percentile(50) * 1000),
+            'p95': "%.2f" % (hist.percentile(95) * 1000),
+            'p99': "%.2f" % (hist.percentile(99) * 1000),
+            'max': "%.2f" % (hist.max * 1000),
+        })
+    return rows
@@ -9,4 +9,6 @@ urlpatterns = [
     url(r'^$', views.stats_page, {}, 'keyedcache_stats'),
     url(r'^view/$', views.view_page, {}, 'keyedcache_view'),
     url(r'^delete/$', views.delete_page, {}, 'keyedcache_delete'),
+    url(r'^metrics/$', views.metrics_page, {}, 'keyedcache_metrics'),
+    url(r'^hotkeys/$', views.hotkeys_page, {}, 'keyedcache_hotkeys'),
 ]
@@ -1,14 +1,26 @@
+import csv
+import heapq
+import json
 import logging
+import time
 
 import keyedcache
 from django import forms
+from django.conf import settings
 from django.contrib.auth.decorators import user_passes_test
-from django.http import HttpResponseRedirect
+from django.http import (HttpResponse, HttpResponseForbidden, HttpResponseRedirect, JsonResponse,
+                         StreamingHttpResponse)
+from django.utils.http import urlencode
+from keyedcache import metrics
 from django.shortcuts import render
 from django.utils.translation import ugettext_lazy as _
 
 log = logging.getLogger(__name__)
 
+# Keys on one page of the key browser
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
 YN = (
     ('Y', _('Yes')),
     ('N', _('No')),
@@ -21,21 +33,38 @@ class CacheDeleteForm(forms.Form):
     kill_all = forms.ChoiceField(label=_('Delete all keys?'), choices=YN, initial="Y")
 
     def delete_cache(self):
+        """Deletes the selected keys and returns the result message.
 
+        The number of deleted keys, the time and the progress by chunks are
+        kept in ``self.report``.
+        """
         data = self.cleaned_data
+        start = time.perf_counter()
+        progress = []
+
+        def step(done, total):
+            progress.append({'done': done, 'total': total, 'ms': (time.perf_counter() - start) * 1000})
+
         if data['kill_all'] == "Y":
-            keyedcache.cache_delete()
-            result = "Deleted all keys"
+            count = len(keyedcache.cache_delete())
+            result = "Deleted all keys, new epoch %d" % keyedcache.cache_epoch()
         elif data['tag']:
-            keyedcache.cache_delete(data['tag'], children=data['children'])
+            key = keyedcache.cache_key(data['tag'])
+            keys = [key]
             if data['children'] == "Y":
+                keys.extend(_matching_keys(key + keyedcache.KEY_DELIM))
                 result = "Deleted %s and children" % data['tag']
             else:
                 result = "Deleted %s" % data['tag']
+            # the keys which were cached, not all the requested ones
+            count = len(keyedcache.cache_delete_many(keys, progress=step))
         else:
+            count = 0
             result = "Nothing selected to delete"
 
-        log.debug(result)
+        self.report = {'result': result, 'keys': count, 'ms': (time.perf_counter() - start) * 1000,
+                       'progress': progress}
+        log.debug("%s: %d keys in %.1f ms", result, count, self.report['ms'])
         return result
 
 
@@ -61,22 +90,124 @@ def stats_page(request):
         'cache_backend': keyedcache.cache.__module__,
         'cache_calls': keyedcache.CACHE_CALLS,
         'cache_hits': keyedcache.CACHE_HITS,
-        'hit_rate': "%02.1f" % rate
+        'hit_rate': "%02.1f" % rate,
+        'timing_enabled': keyedcache._TIMING_ENABLED,
+        'aliases': [{'alias': alias,
+                     'backend': backend.__module__,
+                     'stats': keyedcache.ALIAS_STATS.get(alias, {})}
+                    for alias, backend in keyedcache.cache_aliases()],
+        'latencies': keyedcache.timing.summary(),
+        'hotkeys_enabled': keyedcache._HOTKEY_SAMPLE > 0,
+        'hot_keys': keyedcache.cache_hot_keys(20),
+        'functions': _function_rows(),
     }
 
     return render(request, 'keyedcache/stats.html', ctx)
 
 
+def _function_rows():
+    """Statistics of cache_function results, the most expensive functions first."""
+    rows = []
+    for name, stats in list(keyedcache.FUNCTION_STATS.items()):
+        computed = stats['computed']
+        ms = stats['seconds'] * 1000
+        rows.append(dict(stats, name=name,
+                         avg_ms=ms / computed if computed else 0,
+                         avg_bytes=stats['bytes'] // computed if computed else 0,
+                         bytes_per_ms=stats['bytes'] / ms if ms else 0))
+    rows.sort(key=lambda row: -row['seconds'])
+    return rows
+
+
 stats_page = user_passes_test(lambda u: u.is_authenticated() and u.is_staff if callable(u.is_authenticated) else u.is_authenticated and u.is_staff, login_url='/accounts/login/')(stats_page)
 
 
+def hotkeys_page(request):
+    try:
+        n = int(request.GET.get('n', 10))
+    except ValueError:
+        n = 10
+    return JsonResponse({'sample': keyedcache._HOTKEY_SAMPLE, 'keys': keyedcache.cache_hot_keys(n)})
+
+
+hotkeys_page = user_passes_test(lambda u: u.is_authenticated() and u.is_staff if callable(u.is_authenticated) else u.is_authenticated and u.is_staff, login_url='/accounts/login/')(hotkeys_page)
+
+
+def _matching_keys(prefix):
+    # A copy of the keys only, the registry can be changed by other threads.
+    return (key for key in list(keyedcache.CACHED_KEYS) if key.startswith(prefix))
+
+
+class _Echo(object):
+    def write(self, value):
+        return value
+
+
+def _export_keys(prefix, fmt):
+    """Streams all matching keys (unsorted) as CSV or as a JSON list."""
+    if fmt == 'csv':
+        writer = csv.writer(_Echo())
+        rows = (writer.writerow([key]) for key in _matching_keys(prefix))
+        response = StreamingHttpResponse(rows, content_type='text/csv')
+    else:
+        def rows():
+            yield '['
+            separator = ''
+            for key in _matching_keys(prefix):
+                yield separator + json.dumps(key)
+                separator = ',\n'
+            yield ']\n'
+
+        response = StreamingHttpResponse(rows(), content_type='application/json')
+    response['Content-Disposition'] = 'attachment; filename="keyedcache_keys.%s"' % fmt
+    return response
+
+
 def view_page(request):
-    keys = list(keyedcache.CACHED_KEYS.keys())
+    """Key browser: prefix filter, cursor pagination, export and subtree deletion.
+
+    Only one page of keys is sorted and rendered, so the cost is linear in the
+    size of the registry and the memory does not depend on it.
+    """
+    prefix = request.GET.get('prefix', '')
+
+    if request.method == 'POST':
+        subtree = request.POST.get('delete')
+        if subtree:
+            removed = keyedcache.cache_delete(subtree, children=True)
+            log.debug("Deleted %s and %d children", subtree, len(removed))
+        return HttpResponseRedirect('?' + urlencode({'prefix': prefix}))
+
+    fmt = request.GET.get('format')
+    if fmt in ('json', 'csv'):
+        return _export_keys(prefix, fmt)
 
-    keys.sort()
+    after = request.GET.get('after', '')
+    try:
+        limit = min(int(request.GET.get('limit', PAGE_SIZE)), MAX_PAGE_SIZE)
+    except ValueError:
+        limit = PAGE_SIZE
+
+    groups = {}
+
+    def counted_keys():
+        for key in _matching_keys(prefix):
+            group = prefix + key[len(prefix):].split(keyedcache.KEY_DELIM, 1)[0]
+            groups[group] = groups.get(group, 0) + 1
+            if key > after:
+                yield key
+
+    page = heapq.nsmallest(limit + 1, counted_keys())
+    next_cursor = page[limit - 1] if len(page) > limit else None
+    page = page[:limit]
 
     ctx = {
-        'cached_keys': keys,
+        'prefix': prefix,
+        'key_count': sum(groups.values()),
+        'groups': heapq.nlargest(50, groups.items(), key=lambda item: item[1]),
+        'cached_keys': [dict(key=key, **keyedcache.cache_key_info(key)) for key in page],
+        'next_url': next_cursor and '?' + urlencode({'prefix': prefix, 'after': next_cursor, 'limit': limit}),
+        'export_query': urlencode({'prefix': prefix}),
     }
 
     return render(request, 'keyedcache/view.html', ctx)
@@ -87,12 +218,14 @@ view_page = user_passes_test(lambda u: u.is_authenticated() and u.is_staff if ca
 
 def delete_page(request):
     log.debug("delete_page")
+    report = None
     if request.method == "POST":
         form = CacheDeleteForm(request.POST)
         if form.is_valid():
             log.debug('delete form valid')
-            results = form.delete_cache()
-            return HttpResponseRedirect('../')
+            form.delete_cache()
+            report = form.report
+            form = CacheDeleteForm()
         else:
             log.debug("Errors in form: %s", form.errors)
     else:
@@ -101,9 +234,20 @@ def delete_page(request):
 
     ctx = {
         'form': form,
+        'report': report,
     }
 
     return render(request, 'keyedcache/delete.html', ctx)
 
 
 delete_page = user_passes_test(lambda u: u.is_authenticated() and u.is_staff if callable(u.is_authenticated) else u.is_authenticated and u.is_staff, login_url='/accounts/login/')(delete_page)
+
+
+def metrics_page(request):
+    """Metrics in the OpenMetrics text format, for staff or ``INTERNAL_IPS``."""
+    user = request.user
+    is_staff = (user.is_authenticated() if callable(user.is_authenticated) else user.is_authenticated) and user.is_staff
+    if not is_staff and request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS:
+        return HttpResponseForbidden()
+
+    return HttpResponse(metrics.render(metrics.collect()), content_type=metrics.CONTENT_TYPE)